@@ -1,20 +1,30 @@
 from django.contrib import admin
 from django import forms
 from django.db import transaction
-from django.db.models import QuerySet
+from django.contrib.postgres.search import SearchRank
+from django.db.models import F, Q, QuerySet
 from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
+from django.urls import path, reverse
+from django.utils.html import format_html
 
 from django_admin_search.admin import AdvancedSearchAdmin
 
 from .forms import ChoosePublicationIdentifierForm
+from .jobs import job_progress
 from .models import (
-    Area, Region, Place, Record, PrimaryCategory, SecondaryCategory,
-    Language, Script, Century, Publication
+    Area, Region, Place, Record, PrimaryCategory,
+    SecondaryCategory, Language, Script, Century, Publication, ImportJob,
+    search_query
 )
 
 
 class RecordSearchForm(forms.Form):
+    text = forms.CharField(required=False, label='Full text', widget=forms.TextInput(
+        attrs={
+            'placeholder': 'Inscription, transcription, comments...',
+        }
+    ))
     source = forms.CharField(required=False, widget=forms.TextInput(
         attrs={ 
             'filter_method': '__icontains',
@@ -42,11 +52,94 @@ class RecordSearchForm(forms.Form):
     ))
 
 
+class SearchArrayListFilter(admin.SimpleListFilter):
+    """List filter on a many-to-many field of records that uses the array
+    in the search table (see RecordSearch) instead of joining the through
+    table."""
+    # Array field of RecordSearch and choice model of the values in it
+    field: str
+    model: type
+    value_field = 'name'
+
+    def get_choices(self):
+        return self.model.objects.all()
+
+    def lookups(self, request, model_admin):
+        return [
+            (str(getattr(choice, self.value_field)), str(choice))
+            for choice in self.get_choices()
+        ]
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is None:
+            return queryset
+        if self.value_field != 'name':
+            try:
+                value = int(value)
+            except ValueError:
+                return queryset.none()
+        return queryset.filter(**{f'search__{self.field}__contains': [value]})
+
+
+class CenturyListFilter(SearchArrayListFilter):
+    title = 'estimated centuries'
+    parameter_name = 'century'
+    field = 'century_numbers'
+    model = Century
+    value_field = 'century_number'
+
+    def get_choices(self):
+        return Century.objects.filter(
+            century_number__isnull=False
+        ).order_by('century_number')
+
+    def lookups(self, request, model_admin):
+        return super().lookups(request, model_admin) + [
+            ('unknown', 'Unknown'),
+            ('none', 'None'),
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'unknown':
+            return queryset.filter(search__unknown_century=True)
+        if self.value() == 'none':
+            return queryset.filter(
+                search__century_numbers=[], search__unknown_century=False
+            )
+        return super().queryset(request, queryset)
+
+
+class LanguageListFilter(SearchArrayListFilter):
+    title = 'languages'
+    parameter_name = 'language'
+    field = 'languages'
+    model = Language
+
+
+class ScriptListFilter(SearchArrayListFilter):
+    title = 'scripts'
+    parameter_name = 'script'
+    field = 'scripts'
+    model = Script
+
+    def get_choices(self):
+        # Only scripts that are used by records
+        return Script.objects.filter(
+            pk__in=Record.scripts.through.objects.values('script_id')
+        )
+
+
 @admin.action(description="Fetch information from Pleiades")
 def fetch_from_pleiades(modeladmin, request, queryset):
-    for item in queryset:
-        item.fetch_from_pleiades()
-        item.save()
+    result = Place.objects.update_from_pleiades(queryset)
+    modeladmin.message_user(
+        request,
+        f"Coordinates of {result.changed} places updated, "
+        f"{result.unchanged} unchanged. {result.missing} places not found "
+        f"in Pleiades, {result.no_coordinates} without coordinates in "
+        f"Pleiades, {result.no_pleiades_id} without Pleiades id."
+    )
 
 @admin.register(Place)
 class PlaceAdmin(admin.ModelAdmin):
@@ -73,7 +166,7 @@ class RecordAdmin(AdvancedSearchAdmin):
         'category2', 'period', 'inscriptions_count', 'publication'
     ]
     list_filter = [
-        'area', 'region', 'estimated_centuries', 'languages', ('scripts', admin.RelatedOnlyFieldListFilter), 
+        'area', 'region', CenturyListFilter, LanguageListFilter, ScriptListFilter,
         'category1', 'category2', 'sex_dedicator', 'sex_deceased', 'publication'
     ]
     list_select_related = ["place", "category1", "category2"]
@@ -81,6 +174,31 @@ class RecordAdmin(AdvancedSearchAdmin):
     search_form = RecordSearchForm
     actions = ["add_publication_record"]
 
+    def get_search_text(self) -> str:
+        values = self.advanced_search_fields.get('text')
+        return values[0] if values else ''
+
+    def search_text(self, field, field_value, form_field, request, fields):
+        """Full-text search with the search document of each record"""
+        if not field_value:
+            return Q()
+        return Q(search__document=search_query(field_value))
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        text = self.get_search_text()
+        if text:
+            queryset = queryset.annotate(rank=SearchRank(
+                F('search__document'), search_query(text)
+            ))
+        return queryset
+
+    def get_ordering(self, request):
+        if self.get_search_text():
+            # Best matches first
+            return ['-rank', 'source']
+        return super().get_ordering(request)
+
     @admin.action(description="Add publication record to records")
     def add_publication_record(self, request: HttpRequest, queryset: QuerySet["Record"]) -> HttpResponse:
         if "apply" in request.POST:
@@ -117,6 +235,71 @@ class RecordAdmin(AdvancedSearchAdmin):
         )
 
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = [
+        '__str__', 'mode', 'status', 'created', 'created_by',
+        'rows_processed', 'progress_link'
+    ]
+    list_filter = ['status', 'mode']
+    readonly_fields = [
+        'file', 'mode', 'status', 'created_by', 'created', 'started',
+        'finished', 'rows_processed', 'stage_timings', 'warnings', 'error'
+    ]
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            # Only the file and the mode are given when adding a job
+            return []
+        return self.readonly_fields
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ['file', 'mode']
+        return self.readonly_fields
+
+    @admin.display(description="Progress")
+    def progress_link(self, obj):
+        return format_html(
+            '<a href="{}">Show progress</a>',
+            reverse('admin:data_importjob_progress', args=[obj.pk])
+        )
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.created_by = request.user
+        super().save_model(request, obj, form, change)
+
+    def response_add(self, request, obj, post_url_continue=None):
+        return HttpResponseRedirect(
+            reverse('admin:data_importjob_progress', args=[obj.pk])
+        )
+
+    def get_urls(self):
+        return [
+            path(
+                '<int:pk>/progress/',
+                self.admin_site.admin_view(self.progress_view),
+                name='data_importjob_progress',
+            ),
+        ] + super().get_urls()
+
+    def progress_view(self, request: HttpRequest, pk: int) -> HttpResponse:
+        """Page with the progress of a job, which reloads itself until the
+        job has ended."""
+        if not self.has_view_permission(request):
+            return HttpResponseRedirect(reverse('admin:index'))
+        job = get_object_or_404(ImportJob, pk=pk)
+        return render(request, "data/import_job_progress.html", {
+            **self.admin_site.each_context(request),
+            'title': str(job),
+            'opts': self.model._meta,
+            'job': job,
+            'progress': job_progress(job),
+            'active': job.status in (ImportJob.QUEUED, ImportJob.RUNNING),
+        })
+
+
 admin.site.register(PrimaryCategory)
 admin.site.register(SecondaryCategory)
 admin.site.register(Language)
@@ -0,0 +1,80 @@
+from typing import Any, Dict, List, Optional
+
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Centroid, SnapToGrid
+from django.db.models import Count, QuerySet, Sum
+
+from .serializers import PointField
+
+MAX_ZOOM = 20
+# Number of grid cells along the width of a map tile
+CELLS_PER_TILE = 4
+
+
+def cell_size(zoom: int) -> float:
+    """Give the size of grid cells in degrees at a zoom level. At zoom level
+    0, the whole world is one map tile of 360 degrees."""
+    return 360.0 / (2 ** zoom) / CELLS_PER_TILE
+
+
+def aggregate_records(
+        queryset: QuerySet, zoom: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Count records, their inscriptions and their primary categories per
+    place, or, if a zoom level is given, per cell of a grid that fits that
+    zoom level. Everything is computed in SQL with two grouped queries.
+    Records without location are left out."""
+    # Ordering, such as by search rank, would end up in the GROUP BY
+    queryset = queryset.order_by().filter(
+        place__coordinates__isnull=False, place__coordinates__isempty=False
+    )
+    totals = {
+        'records': Count('pk'),
+        'inscriptions': Sum('inscriptions_count'),
+    }
+    if zoom is None:
+        group_by = ['place_id', 'place__name', 'place__coordinates']
+        rows = queryset.values(*group_by).annotate(**totals)
+        categories = queryset.values('place_id', 'category1__name') \
+            .annotate(count=Count('pk'))
+        key = 'place_id'
+    else:
+        queryset = queryset.annotate(
+            cell=SnapToGrid('place__coordinates', cell_size(zoom))
+        )
+        rows = queryset.values('cell').annotate(
+            center=Centroid(Collect('place__coordinates')),
+            places=Count('place_id', distinct=True),
+            **totals
+        )
+        categories = queryset.values('cell', 'category1__name') \
+            .annotate(count=Count('pk'))
+        key = 'cell'
+
+    def group_key(row):
+        # Geometries are compared by their coordinates
+        return row[key].coords if zoom is not None else row[key]
+
+    breakdown: Dict[Any, Dict[str, int]] = {}
+    for row in categories:
+        category = row['category1__name'] or ''
+        breakdown.setdefault(group_key(row), {})[category] = row['count']
+
+    point_field = PointField()
+    result = []
+    for row in rows:
+        item = {
+            'coordinates': point_field.to_representation(
+                row['place__coordinates'] if zoom is None else row['center']
+            ),
+            'records': row['records'],
+            'inscriptions': row['inscriptions'] or 0,
+            'categories': breakdown.get(group_key(row), {}),
+        }
+        if zoom is None:
+            item['place_id'] = row['place_id']
+            item['place_name'] = row['place__name']
+        else:
+            item['places'] = row['places']
+        result.append(item)
+    return result
@@ -0,0 +1,419 @@
+"""Benchmarks of the import, the Pleiades index, the API and the admin,
+on a synthetic corpus of any size. Run them with manage.py benchmark."""
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import json
+import random
+import subprocess
+import tempfile
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+import openpyxl
+
+from .bulk_import import (
+    bulk_import_dataset, delete_dataset_rows, incremental_import_dataset
+)
+from .models import Place, Record
+from .pleiades import pleiades_fetcher
+from .serializers import FastRecordSerializer, RecordSerializer
+from .snapshot import current_version, render_snapshot
+
+
+def measure(function: Callable[[], object], repeat: int) -> Dict[str, Any]:
+    """Give the fastest wall time of a number of calls of a function and
+    the number of queries of the last call."""
+    seconds = []
+    queries = 0
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            start = perf_counter()
+            function()
+            seconds.append(perf_counter() - start)
+        queries = len(captured)
+    return {'seconds': min(seconds), 'queries': queries}
+
+
+def render_records(queryset: QuerySet) -> bytes:
+    """Render records to JSON with RecordSerializer."""
+    queryset = queryset.select_related(
+        'place', 'category1', 'category2', 'publication', 'place__area', 'place__region'
+    ).prefetch_related(
+        'languages', 'scripts', 'estimated_centuries'
+    )
+    return JSONRenderer().render(RecordSerializer(queryset, many=True).data)
+
+
+def fast_render_records(queryset: QuerySet) -> bytes:
+    """Render records to JSON with FastRecordSerializer."""
+    return JSONRenderer().render([
+        FastRecordSerializer.to_representation(row)
+        for row in FastRecordSerializer.annotate(queryset)
+    ])
+
+
+def benchmark_record_serializers(repeat: int = 3) -> Dict[str, Dict[str, Any]]:
+    """Time rendering all records with RecordSerializer and with
+    FastRecordSerializer, including the queries."""
+    queryset = Record.objects.order_by('source')
+    return {
+        'RecordSerializer': measure(lambda: render_records(queryset), repeat),
+        'FastRecordSerializer': measure(
+            lambda: fast_render_records(queryset), repeat
+        ),
+    }
+
+
+# Synthetic corpus
+
+# Columns of the data sheet, as expected by import_dataset
+DATA_COLUMNS = [
+    'id', 'area', 'province-region', 'placename', 'pleiades', 'own id ',
+    'category 1', 'category 2', 'period', 'centuries', 'inscriptions-count',
+    'language', 'script', 'source', 'comments', 'mention religious symbol',
+    'mentioned placenames', 'mention religious profession',
+    'sexe dedicator epitaph (male/female/child)',
+    'sexe of deceased (male/female/child)', 'transcription ', 'inscription',
+]
+LOCATION_COLUMNS = [
+    'id', 'area', 'Province-region', 'placename', 'latitude-man',
+    'longitude-man',
+]
+AREAS = {
+    'Algeria': ['Africa Proconsularis', 'Mauretania Caesariensis'],
+    'Tunisia': ['Africa Proconsularis', 'Byzacena'],
+    'Italy': ['Latium', 'Campania', 'Apulia'],
+    'Asia Minor': ['Pontus et Bithynia', 'Lydia', 'Phrygia'],
+    'Egypt': ['Aegyptus'],
+    'Greece': ['Achaia', 'Macedonia'],
+}
+CATEGORIES = {
+    'Inscription': ['Epitaph', 'Dedication', 'Column', 'Graffito'],
+    'Literary source': ['Chronicle', 'Letter'],
+    'Other': ['Artefact: Amulet', 'Artefact: Lamp', 'Papyrus'],
+}
+LANGUAGES = ['Latin', 'Greek', 'Hebrew', 'Aramaic']
+SCRIPTS = ['Latin', 'Greek', 'Hebrew', 'Aramaic']
+CENTURIES = ['-2', '-1', '1', '2', '3', '4', '5', '6', '7', 'unknown']
+SEXES = ['Male', 'Female', 'Child', 'Child (Male)', 'Child (Female)']
+SYMBOLS = ['menorah', 'shofar', 'lulav', 'etrog']
+PROFESSIONS = ['archisynagogos', 'presbyter', 'pater synagogae', 'rabbi']
+WORDS = [
+    'hic', 'iacet', 'in', 'pace', 'vixit', 'annis', 'pater', 'mater',
+    'filius', 'filia', 'Iudaeus', 'Iudaea', 'benemerenti', 'fecit', 'synagoga',
+    'shalom', 'eirene', 'ioudaios', 'enthade', 'keitai', 'memoria', 'deo',
+]
+# Number of records per place in the synthetic corpus
+RECORDS_PER_PLACE = 20
+# Synthetic Pleiades ids start here
+FIRST_PLEIADES_ID = 100000
+
+
+def to_dms(value: float, positive: str, negative: str) -> str:
+    """Write a coordinate like the location sheet does, e.g. 35˚ 24' 7''N"""
+    direction = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = int(((value - degrees) * 60 - minutes) * 60)
+    return f"{degrees}˚ {minutes}' {seconds}''{direction}"
+
+
+def synthetic_places(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Give places around the Mediterranean. About two thirds have a
+    Pleiades id; the others have an id in the location sheet. A few of the
+    Pleiades ids are not in the synthetic dump, like in the real data."""
+    rng = random.Random(seed)
+    places = []
+    for index in range(count):
+        area = rng.choice(list(AREAS))
+        place = {
+            'name': f'Place {index}',
+            'area': area,
+            'region': rng.choice(AREAS[area]),
+            'longitude': round(rng.uniform(-6.0, 36.0), 5),
+            'latitude': round(rng.uniform(30.0, 45.0), 5),
+            'pleiades': None,
+            'own_id': None,
+            'in_pleiades': True,
+        }
+        if rng.random() < 2 / 3:
+            place['pleiades'] = FIRST_PLEIADES_ID + index
+            place['in_pleiades'] = rng.random() > 0.02
+        else:
+            place['own_id'] = f'H{index}'
+        places.append(place)
+    return places
+
+
+def write_synthetic_workbook(path, rows: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Write an input file with the given number of records, with the
+    sheets and columns that import_dataset expects. Return the places, so
+    that a matching Pleiades dump can be written."""
+    rng = random.Random(seed)
+    places = synthetic_places(max(1, rows // RECORDS_PER_PLACE), seed)
+
+    def text(words: int) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+    def choices(values: List[str], most: int) -> str:
+        return '|'.join(rng.sample(values, rng.randint(1, most)))
+
+    workbook = openpyxl.Workbook(write_only=True)
+    data = workbook.create_sheet('Data JewishMigration')
+    data.append(DATA_COLUMNS)
+    for index in range(rows):
+        place = rng.choice(places)
+        category1 = rng.choice(list(CATEGORIES))
+        data.append([
+            index + 1, place['area'], place['region'], place['name'],
+            place['pleiades'], place['own_id'], category1,
+            rng.choice(CATEGORIES[category1]), 'III AD - IV AD',
+            choices(CENTURIES, 3), rng.randint(1, 3), choices(LANGUAGES, 2),
+            choices(SCRIPTS, 2), f'Synthetic {seed} n. {index + 1}',
+            text(rng.randint(3, 20)),
+            rng.choice(SYMBOLS) if rng.random() < 0.3 else None,
+            rng.choice(places)['name'] if rng.random() < 0.1 else None,
+            rng.choice(PROFESSIONS) if rng.random() < 0.1 else None,
+            choices(SEXES, 2) if rng.random() < 0.5 else None,
+            choices(SEXES, 2) if rng.random() < 0.5 else None,
+            text(rng.randint(5, 40)), text(rng.randint(5, 40)),
+        ])
+    locations = workbook.create_sheet('ID settlements without Pleiades')
+    locations.append(LOCATION_COLUMNS)
+    for place in places:
+        if place['own_id']:
+            locations.append([
+                place['own_id'], place['area'], place['region'],
+                place['name'], to_dms(place['latitude'], 'N', 'S'),
+                to_dms(place['longitude'], 'E', 'W'),
+            ])
+    workbook.save(path)
+    return places
+
+
+def write_synthetic_pleiades(path, places: List[Dict[str, Any]], extra: int = 0, seed: int = 0) -> None:
+    """Write an uncompressed Pleiades JSON dump with the places that have a
+    Pleiades id, followed by extra places that are not in the workbook
+    (the real dump has about 40,000 places). Some places have no
+    reprPoint."""
+    rng = random.Random(seed)
+    entries = [
+        (place['pleiades'], [place['longitude'], place['latitude']])
+        for place in places if place['pleiades'] and place['in_pleiades']
+    ]
+    first_extra = FIRST_PLEIADES_ID + len(places)
+    entries.extend(
+        (first_extra + index, [
+            round(rng.uniform(-10.0, 60.0), 5),
+            round(rng.uniform(20.0, 55.0), 5),
+        ] if rng.random() > 0.05 else None)
+        for index in range(extra)
+    )
+    with open(path, 'w') as f:
+        json.dump({'@context': {}, '@graph': [{
+            'id': str(pleiades_id),
+            'title': f'Pleiades place {pleiades_id}',
+            'description': 'A synthetic place',
+            'reprPoint': reprpoint,
+            'features': [],
+        } for pleiades_id, reprpoint in entries]}, f)
+
+
+# Benchmark suite
+
+# Settings for the benchmarks: caches are kept in memory, so that the
+# snapshot of the synthetic data does not end up in the shared cache.
+# Tiles are cached in the temporary directory of the run.
+BENCHMARK_SETTINGS = {
+    'CACHES': {
+        alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        for alias in ['default', 'snapshots', 'progress']
+    },
+    'ALLOWED_HOSTS': ['testserver'],
+}
+
+
+@contextmanager
+def synthetic_pleiades(path: Path) -> Iterator[None]:
+    """Let the Pleiades fetcher use the dump at path, with its index next
+    to it, instead of the real Pleiades data."""
+    saved = (
+        pleiades_fetcher.pleiades_path, pleiades_fetcher.pleiades_index_path,
+        pleiades_fetcher.pleiades_metadata_path,
+    )
+    pleiades_fetcher.reset()
+    pleiades_fetcher.pleiades_path = path
+    pleiades_fetcher.pleiades_index_path = path.with_suffix('.index')
+    pleiades_fetcher.pleiades_metadata_path = path.with_suffix('.index.json')
+    try:
+        yield
+    finally:
+        pleiades_fetcher.reset()
+        (
+            pleiades_fetcher.pleiades_path,
+            pleiades_fetcher.pleiades_index_path,
+            pleiades_fetcher.pleiades_metadata_path,
+        ) = saved
+
+
+def benchmark_pleiades(
+        path: Path, places: List[Dict[str, Any]], repeat: int
+) -> Dict[str, Dict[str, Any]]:
+    ids = [place['pleiades'] for place in places if place['pleiades']]
+
+    def fetch_each():
+        for pleiades_id in ids:
+            pleiades_fetcher.fetch(pleiades_id)
+
+    return {
+        'pleiades_build_index': measure(pleiades_fetcher.build_index, repeat),
+        'pleiades_fetch': measure(fetch_each, repeat),
+        'pleiades_fetch_many': measure(
+            lambda: pleiades_fetcher.fetch_many(ids), repeat
+        ),
+    }
+
+
+class LiveDatabaseError(RuntimeError):
+    pass
+
+
+@contextmanager
+def benchmark_database() -> Iterator[None]:
+    """Create a separate, empty database like the test runner does, use it
+    instead of the configured database, and drop it afterwards."""
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    saved_name = connection.settings_dict['NAME']
+    saved_test_name = test_settings.get('NAME')
+    # Leave the database of the tests alone
+    test_settings['NAME'] = f'benchmark_{saved_name}'
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(saved_name, verbosity=0)
+        test_settings['NAME'] = saved_test_name
+
+
+def benchmark_import(workbook: Path, repeat: int) -> Dict[str, Dict[str, Any]]:
+    """Time a bulk import into empty tables, and an incremental import
+    that finds nothing to change. The data is left in place. This deletes
+    all records, so it must only run in the transaction of
+    run_benchmarks."""
+    def bulk_import():
+        delete_dataset_rows()
+        bulk_import_dataset(workbook)
+
+    return {
+        'import_bulk': measure(bulk_import, repeat),
+        'import_incremental_unchanged': measure(
+            lambda: incremental_import_dataset(workbook), repeat
+        ),
+    }
+
+
+def benchmark_requests(
+        urls: Dict[str, str], user, repeat: int
+) -> Dict[str, Dict[str, Any]]:
+    client = Client()
+    client.force_login(user)
+    results = {}
+    for name, url in urls.items():
+        def get(url=url):
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} gave status {response.status_code}')
+            # Streaming responses are only rendered when consumed
+            return b''.join(response) if response.streaming else response.content
+        results[name] = measure(get, repeat)
+    return results
+
+
+def run_benchmarks(
+        rows: int, repeat: int = 3, directory: Optional[Path] = None,
+        allow_live_db: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    """Run the benchmarks on a synthetic corpus of the given number of
+    rows, and give the wall time in seconds and the number of queries of
+    each. All data is written in a transaction that is rolled back.
+
+    The benchmarks delete the dataset and lock its tables while they run,
+    so they refuse to run on a database with records or places (see
+    benchmark_database), unless allow_live_db is set."""
+    if not allow_live_db and (Record.objects.exists() or Place.objects.exists()):
+        raise LiveDatabaseError(
+            'The database contains data; run the benchmarks on an empty '
+            'database'
+        )
+    results: Dict[str, Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory(dir=directory) as temp, \
+            override_settings(
+                TILE_CACHE_DIRECTORY=Path(temp) / 'tiles', **BENCHMARK_SETTINGS
+            ):
+        workbook = Path(temp) / 'synthetic.xlsx'
+        dump = Path(temp) / 'pleiades.json'
+        places = write_synthetic_workbook(workbook, rows)
+        write_synthetic_pleiades(dump, places, extra=rows)
+        with synthetic_pleiades(dump):
+            results.update(benchmark_pleiades(dump, places, repeat))
+            with transaction.atomic():
+                results.update(benchmark_import(workbook, repeat))
+                user = get_user_model().objects.create_superuser(
+                    username=f'benchmark-{uuid.uuid4().hex}'
+                )
+                results.update(benchmark_requests({
+                    'api_records_page': '/api/records/',
+                    'api_records_page_filtered':
+                        '/api/records/?languages=Greek&century_min=2&century_max=4',
+                    'api_records_search': '/api/records/?q=synagoga',
+                    'api_records_all': '/api/records/?paginate=false',
+                    'api_records_stream': '/api/records/stream/',
+                    'api_records_aggregate': '/api/records/aggregate/?zoom=4',
+                    'api_tile': '/api/tiles/3/4/2.mvt',
+                    'admin_records': '/admin/data/record/',
+                    'admin_records_filtered':
+                        '/admin/data/record/?language=Greek&century=3',
+                    'admin_records_search': '/admin/data/record/?text=synagoga',
+                    'admin_records_substring': '/admin/data/record/?source=n.+1',
+                }, user, repeat))
+                results['snapshot_render'] = measure(
+                    lambda: render_snapshot(current_version()), repeat
+                )
+                for name, result in benchmark_record_serializers(repeat).items():
+                    results[f'render_{name}'] = result
+                transaction.set_rollback(True)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    """Give the hash of the checked out commit, if known"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(path: Path, entry: Dict[str, Any]) -> None:
+    """Add the results of a run to the JSON history file, which holds a
+    list of runs."""
+    try:
+        with open(path) as f:
+            history = json.load(f)
+    except FileNotFoundError:
+        history = []
+    history.append(entry)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
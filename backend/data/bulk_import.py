@@ -0,0 +1,560 @@
+from itertools import islice
+from typing import (
+    Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Type
+)
+import logging
+
+from django.db import connection, models, transaction
+
+from .models import (
+    Area, Region, Place, Record, RecordSearch, BaseChoiceField,
+    PrimaryCategory, SecondaryCategory, Language, Script, Century,
+    ChoiceFieldCache,
+    normalize_century, open_dataset, parse_choice_value,
+    parse_choice_values, place_content_hash, record_fields_from_row,
+)
+from .snapshot import invalidate_snapshot_on_commit
+from .utils import content_hash
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+# Number of rows that are read from the input file before writing them
+CHUNK_SIZE = 5000
+
+# Columns that map to a single choice field entry
+SINGLE_CHOICE_COLUMNS = {
+    'category1': ('category 1', PrimaryCategory),
+    'category2': ('category 2', SecondaryCategory),
+}
+
+# Columns that map to many choice field entries, split by '|'
+MULTIPLE_CHOICE_COLUMNS = {
+    'languages': ('language', Language, None),
+    'scripts': ('script', Script, None),
+    'estimated_centuries': ('centuries', Century, normalize_century),
+}
+
+PlaceKey = Tuple[str, Optional[int], Optional[int]]
+
+
+def resolve_names(
+        model: Type[models.Model], names: Iterable[str]
+) -> Dict[str, models.Model]:
+    """Give a dictionary from name to instance for all given names of areas
+    or regions. Existing instances are fetched with one query; missing ones
+    are created in batches."""
+    names = set(names)
+    resolved: Dict[str, models.Model] = {}
+    if not names:
+        return resolved
+    for instance in model.objects.filter(name__in=names):
+        # Names of areas and regions are not unique; like get_or_create,
+        # we take the first match
+        resolved.setdefault(instance.name, instance)
+    new_instances = [model(name=name) for name in names - resolved.keys()]
+    for instance in model.objects.bulk_create(
+            new_instances, batch_size=BATCH_SIZE
+    ):
+        resolved[instance.name] = instance
+    return resolved
+
+
+class ImportProgress:
+    """Receives the progress of an import: the start of each stage and the
+    number of rows written. This base class ignores it; see
+    jobs.JobProgress."""
+
+    def stage(self, name: str) -> None:
+        pass
+
+    def rows(self, count: int) -> None:
+        pass
+
+
+class BulkImporter:
+    """Import rows from the input file with a fixed number of queries per
+    chunk of rows.
+
+    Rows are read in chunks of chunk_size. For each chunk, all lookup
+    tables are resolved in batches, and places, records and the
+    many-to-many relations between records and choice fields are written
+    with bulk_create and bulk_update. All chunks are written in one
+    transaction.
+
+    Like the individual import, empty columns leave the existing value of
+    a record untouched, unless replace is set: then each record is made
+    exactly like its row. The coordinates of an existing place are taken
+    again when the content hash of its data changed.
+    """
+
+    def __init__(
+            self, locations, chunk_size: int = CHUNK_SIZE,
+            replace: bool = False, progress: Optional[ImportProgress] = None
+    ):
+        # Index of the sheet with location info, see utils.location_index
+        self.locations = locations
+        self.chunk_size = chunk_size
+        self.replace = replace
+        self.progress = progress or ImportProgress()
+        self.choice_cache = ChoiceFieldCache()
+        # Existing places whose coordinates were taken again
+        self.updated_place_ids: List[int] = []
+
+    def import_rows(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Import all rows and return the number of records written."""
+        rows = iter(rows)
+        record_ids: List[int] = []
+        self.updated_place_ids = []
+        self.progress.stage('importing rows')
+        with transaction.atomic():
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                places = self._resolve_places(chunk)
+                record_ids.extend(
+                    record.pk for record in self._write_records(chunk, places)
+                )
+                self.progress.rows(len(chunk))
+            self.progress.stage('refreshing search table')
+            # Records of updated places get new coordinates, too
+            RecordSearch.objects.refresh(set(record_ids).union(
+                Record.objects.filter(
+                    place__in=self.updated_place_ids
+                ).values_list('pk', flat=True)
+            ))
+        # Bulk queries do not send signals. Wait for the outer transaction,
+        # if any, so that no snapshot of the old data gets the new version.
+        invalidate_snapshot_on_commit()
+        return len(record_ids)
+
+    def _resolve_places(
+            self, rows: List[Dict[str, Any]]
+    ) -> List[Optional[Place]]:
+        """Give the place for each row, creating the places that do not
+        yet exist."""
+        areas = resolve_names(Area, (
+            row['area'].strip() for row in rows
+            if row['placename'] is not None and row.get('area')
+        ))
+        regions = resolve_names(Region, (
+            row['province-region'].strip() for row in rows
+            if row['placename'] is not None and row.get('province-region')
+        ))
+
+        keys: List[Optional[PlaceKey]] = []
+        for row in rows:
+            if row['placename'] is None:
+                # No placename defined; the record gets no place
+                keys.append(None)
+                continue
+            area = areas[row['area'].strip()] if row.get('area') else None
+            region = regions[row['province-region'].strip()] \
+                if row.get('province-region') else None
+            keys.append((
+                row['placename'],
+                area.pk if area else None,
+                region.pk if region else None,
+            ))
+
+        existing: Dict[PlaceKey, Place] = {}
+        names = {key[0] for key in keys if key}
+        for place in Place.objects.filter(name__in=names).order_by('pk'):
+            existing.setdefault(
+                (place.name, place.area_id, place.region_id), place
+            )
+
+        new_places: Dict[PlaceKey, Place] = {}
+        updated_places: Dict[PlaceKey, Place] = {}
+        seen: Set[PlaceKey] = set()
+        for key, row in zip(keys, rows):
+            if key is None or key in seen:
+                # Data for one place should always be the same, so only
+                # the first row of a place is used
+                continue
+            seen.add(key)
+            place_hash = place_content_hash(row, self.locations)
+            place = existing.get(key)
+            if place is None:
+                place = Place(name=key[0], area_id=key[1], region_id=key[2])
+                new_places[key] = place
+            elif place.content_hash == place_hash:
+                continue
+            elif not place.content_hash:
+                # Imported before content hashes were stored; assume that
+                # the place is up to date
+                place.content_hash = place_hash
+                updated_places[key] = place
+                continue
+            else:
+                updated_places[key] = place
+                self.updated_place_ids.append(place.pk)
+            place.content_hash = place_hash
+            place.pleiades_id = row['pleiades'] \
+                if isinstance(row['pleiades'], int) else None
+            coordinates = None
+            if place.pleiades_id:
+                coordinates = place.fetch_from_pleiades()
+                if not coordinates:
+                    logger.warning(
+                        f"Cannot find coordinates for pleiades ID {place.pleiades_id}. "
+                        "Taking information from document instead."
+                    )
+            if coordinates is None:
+                coordinates = place.fetch_from_document(
+                    self.locations, row['own id ']
+                )
+            place.coordinates = coordinates
+        Place.objects.bulk_create(new_places.values(), batch_size=BATCH_SIZE)
+        Place.objects.bulk_update(
+            updated_places.values(),
+            ['pleiades_id', 'coordinates', 'content_hash'],
+            batch_size=BATCH_SIZE
+        )
+        existing.update(new_places)
+
+        # Attach areas and regions so that the denormalized fields of the
+        # records can be filled in without further queries
+        areas_by_pk = {area.pk: area for area in areas.values()}
+        regions_by_pk = {region.pk: region for region in regions.values()}
+        places = []
+        for key in keys:
+            place = existing[key] if key else None
+            if place:
+                place.area = areas_by_pk.get(place.area_id)
+                place.region = regions_by_pk.get(place.region_id)
+            places.append(place)
+        return places
+
+    def _write_records(
+            self, rows: List[Dict[str, Any]], places: List[Optional[Place]]
+    ) -> List[Record]:
+        """Create or update the records of all rows, including their
+        relations to choice fields."""
+        choices = self._resolve_choices(rows)
+
+        by_source: Dict[str, Tuple[Dict[str, Any], Optional[Place]]] = {}
+        for row, place in zip(rows, places):
+            if row['id'] is None or row['id'] == '':
+                logger.warning('Ignoring row with empty id column')
+                continue
+            # If a source occurs more than once, the last row wins
+            by_source[row['source']] = (row, place)
+
+        existing = Record.objects.in_bulk(
+            list(by_source.keys()), field_name='source'
+        )
+        new_records: List[Record] = []
+        updated_records: List[Record] = []
+        update_fields: Set[str] = {'place', 'area', 'region'}
+        for source, (row, place) in by_source.items():
+            record = existing.get(source)
+            if record is None:
+                record = Record(source=source)
+                new_records.append(record)
+            else:
+                updated_records.append(record)
+            record.place = place
+            if place:
+                for field, value in place.denormalized_fields().items():
+                    setattr(record, field, value)
+            else:
+                record.area = record.region = None
+            fields = record_fields_from_row(row)
+            if self.replace:
+                fields.setdefault('sex_dedicator', '')
+                fields.setdefault('sex_deceased', '')
+            for field, value in fields.items():
+                setattr(record, field, value)
+            update_fields.update(fields.keys())
+            for field, (column, model) in SINGLE_CHOICE_COLUMNS.items():
+                if row[column]:
+                    setattr(record, field, choices[model][
+                        parse_choice_value(row[column])
+                    ])
+                    update_fields.add(field)
+                elif self.replace:
+                    setattr(record, field, None)
+                    update_fields.add(field)
+
+        Record.objects.bulk_create(new_records, batch_size=BATCH_SIZE)
+        Record.objects.bulk_update(
+            updated_records, sorted(update_fields), batch_size=BATCH_SIZE
+        )
+        records = new_records + updated_records
+        self._write_relations(records, by_source, choices)
+        return records
+
+    def _resolve_choices(
+            self, rows: List[Dict[str, Any]]
+    ) -> Dict[Type[BaseChoiceField], Dict[str, BaseChoiceField]]:
+        names: Dict[Type[BaseChoiceField], Set[str]] = {}
+        for column, model in SINGLE_CHOICE_COLUMNS.values():
+            names[model] = {
+                parse_choice_value(row[column]) for row in rows if row[column]
+            }
+        for column, model, transformer in MULTIPLE_CHOICE_COLUMNS.values():
+            names[model] = set()
+            for row in rows:
+                if row[column]:
+                    names[model].update(
+                        parse_choice_values(row[column], '|', transformer)
+                    )
+        return {
+            model: dict(zip(
+                model_names, self.choice_cache.get_many(model, model_names)
+            ))
+            for model, model_names in names.items()
+        }
+
+    def _write_relations(
+            self, records: List[Record],
+            by_source: Dict[str, Tuple[Dict[str, Any], Optional[Place]]],
+            choices: Dict[Type[BaseChoiceField], Dict[str, BaseChoiceField]],
+    ) -> None:
+        """Replace the many-to-many relations of the records with the ones
+        given in the input file. Like with the individual import, relations
+        are left untouched if the column is empty, unless replace is set."""
+        for field, (column, model, transformer) in \
+                MULTIPLE_CHOICE_COLUMNS.items():
+            through = getattr(Record, field).through
+            record_column = 'record_id'
+            choice_column = f'{model._meta.model_name}_id'
+            changed_ids = []
+            through_rows = []
+            for record in records:
+                value = by_source[record.source][0][column]
+                if not value and not self.replace:
+                    continue
+                changed_ids.append(record.pk)
+                choice_ids = {
+                    choices[model][name].pk for name in
+                    parse_choice_values(value, '|', transformer)
+                } if value else set()
+                through_rows.extend(
+                    through(**{
+                        record_column: record.pk, choice_column: choice_id
+                    }) for choice_id in choice_ids
+                )
+            through.objects.filter(
+                **{f'{record_column}__in': changed_ids}
+            ).delete()
+            through.objects.bulk_create(through_rows, batch_size=BATCH_SIZE)
+
+
+def bulk_import_dataset(
+        input_file, progress: Optional[ImportProgress] = None
+) -> int:
+    """Import the dataset like import_dataset does, but with a few queries
+    per chunk of rows instead of several per row. Return the number of
+    records written."""
+    progress = progress or ImportProgress()
+    progress.stage('reading locations')
+    with open_dataset(input_file) as (locations, rows):
+        return BulkImporter(locations, progress=progress).import_rows(rows)
+
+
+class ImportDiff(NamedTuple):
+    """Sources of records by how their rows differ from the stored records,
+    and names of existing places whose location data changed, as found by
+    incremental_import_dataset"""
+    new: List[str]
+    changed: List[str]
+    unchanged: List[str]
+    deleted: List[str]
+    changed_places: List[str]
+
+
+def place_key(row: Dict[str, Any]) -> Tuple[str, Optional[str], Optional[str]]:
+    """Give the name, area name and region name of the place of a row, as
+    BulkImporter matches them to existing places"""
+    return (
+        row['placename'],
+        row['area'].strip() if row.get('area') else None,
+        row['province-region'].strip() if row.get('province-region') else None,
+    )
+
+
+def changed_place_rows(
+        rows: Iterable[Dict[str, Any]], locations
+) -> Dict[str, Dict[str, Any]]:
+    """Give the first row of each existing place whose location data in the
+    input file differs from the stored content hash, by source. Places
+    without a stored hash are assumed to be up to date, like BulkImporter
+    does."""
+    stored = {}
+    for name, area, region, place_hash in Place.objects.order_by('pk') \
+            .values_list('name', 'area__name', 'region__name', 'content_hash'):
+        stored.setdefault((name, area, region), place_hash)
+    changed: Dict[str, Dict[str, Any]] = {}
+    seen = set()
+    for row in rows:
+        if row['placename'] is None:
+            continue
+        key = place_key(row)
+        if key in seen:
+            # Data for one place should always be the same, so only the
+            # first row of a place is used
+            continue
+        seen.add(key)
+        place_hash = stored.get(key)
+        if place_hash and place_hash != place_content_hash(row, locations):
+            changed[row['source']] = row
+    return changed
+
+
+def incremental_import_dataset(
+        input_file, dry_run: bool = False,
+        progress: Optional[ImportProgress] = None
+) -> ImportDiff:
+    """Compare the rows of the input file with the stored records and
+    places by their content hash, and only write what changed: records of
+    new and changed rows are written like bulk_import_dataset does (with
+    replace set), places whose location data changed get new coordinates,
+    and records whose source is no longer in the input file are deleted.
+    Places that are left without records are deleted as well. With
+    dry_run, nothing is written."""
+    progress = progress or ImportProgress()
+    progress.stage('reading rows')
+    with open_dataset(input_file) as (locations, rows):
+        by_source: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            if row['id'] is None or row['id'] == '':
+                logger.warning('Ignoring row with empty id column')
+                continue
+            # If a source occurs more than once, the last row wins
+            by_source[row['source']] = row
+    progress.stage('comparing rows')
+    stored = dict(Record.objects.values_list('source', 'content_hash'))
+    diff = ImportDiff([], [], [], [], [])
+    for source, row in by_source.items():
+        if source not in stored:
+            diff.new.append(source)
+        elif stored[source] != content_hash(row):
+            diff.changed.append(source)
+        else:
+            diff.unchanged.append(source)
+    diff.deleted.extend(source for source in stored if source not in by_source)
+    # The importer updates a changed place from the first row that it is
+    # given for it, so that row is written again as well
+    place_rows = changed_place_rows(by_source.values(), locations)
+    diff.changed_places.extend(row['placename'] for row in place_rows.values())
+    if dry_run or not (
+            diff.new or diff.changed or diff.deleted or diff.changed_places
+    ):
+        return diff
+
+    with transaction.atomic():
+        progress.stage('deleting records')
+        deleted = Record.objects.filter(source__in=diff.deleted)
+        # Changed records may move to another place
+        place_ids = set(Record.objects.filter(
+            source__in=diff.deleted + diff.changed
+        ).values_list('place_id', flat=True))
+        deleted.delete()
+        sources = list(place_rows) + [
+            source for source in diff.new + diff.changed
+            if source not in place_rows
+        ]
+        BulkImporter(locations, replace=True, progress=progress).import_rows(
+            by_source[source] for source in sources
+        )
+        Place.objects.filter(pk__in=place_ids, records__isnull=True).delete()
+    return diff
+
+
+class DatasetValidationError(RuntimeError):
+    pass
+
+
+def delete_dataset_rows() -> None:
+    """Delete all imported data except publications with plain DELETE
+    statements. Unlike TRUNCATE, this does not lock out readers: until the
+    transaction is committed, they keep seeing the old data."""
+    tables = [
+        getattr(Record, field).through._meta.db_table
+        for field in MULTIPLE_CHOICE_COLUMNS
+    ] + [model._meta.db_table for model in [
+        RecordSearch, Record, Place, Area, Region, PrimaryCategory,
+        SecondaryCategory, Language, Script, Century,
+    ]]
+    with connection.cursor() as cursor:
+        for table in tables:
+            cursor.execute(f'DELETE FROM {table}')
+
+
+def replace_dataset(
+        input_file, progress: Optional[ImportProgress] = None
+) -> int:
+    """Replace all data with the dataset in the input file in one
+    transaction, so that readers see either the complete old or the
+    complete new dataset. The new data is validated before it is
+    committed; if it is incomplete, DatasetValidationError is raised and
+    nothing changes. Publications and the links of records to them (which
+    are not in the input file) are kept. Return the number of records."""
+    progress = progress or ImportProgress()
+    with transaction.atomic():
+        progress.stage('deleting old data')
+        publications = {
+            source: (publication_id, location)
+            for source, publication_id, location in Record.objects.exclude(
+                publication=None, location_in_publication=''
+            ).values_list('source', 'publication_id', 'location_in_publication')
+        }
+        delete_dataset_rows()
+
+        sources: Set[str] = set()
+        placed: Set[str] = set()
+
+        def track(rows):
+            for row in rows:
+                if row['id'] is not None and row['id'] != '':
+                    # If a source occurs more than once, the last row wins
+                    sources.add(row['source'])
+                    if row['placename'] is None:
+                        placed.discard(row['source'])
+                    else:
+                        placed.add(row['source'])
+                yield row
+
+        progress.stage('reading locations')
+        with open_dataset(input_file) as (locations, rows):
+            BulkImporter(locations, progress=progress).import_rows(
+                track(rows)
+            )
+
+        records = list(Record.objects.filter(
+            source__in=publications.keys()
+        ).only('pk', 'source'))
+        for record in records:
+            record.publication_id, record.location_in_publication = \
+                publications[record.source]
+        Record.objects.bulk_update(
+            records, ['publication', 'location_in_publication'],
+            batch_size=BATCH_SIZE
+        )
+
+        progress.stage('validating')
+        count = Record.objects.count()
+        problems = []
+        if count != len(sources):
+            problems.append(
+                f'{count} records written for {len(sources)} sources'
+            )
+        with_place = Record.objects.filter(place__isnull=False).count()
+        if with_place != len(placed):
+            problems.append(
+                f'{with_place} records with a place, expected {len(placed)}'
+            )
+        search_count = RecordSearch.objects.count()
+        if search_count != count:
+            problems.append(
+                f'{search_count} rows in the search table for {count} records'
+            )
+        if problems:
+            # Roll back, so that the old data stays in place
+            raise DatasetValidationError(
+                'Import is incomplete: {}'.format('; '.join(problems))
+            )
+    return count
@@ -0,0 +1,157 @@
+from math import cos, radians
+from typing import List, Optional
+
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.contrib.postgres.search import SearchRank
+from django.db.models import F, FloatField, Max, Min
+from django.db.models.functions import Cast
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Century, search_query
+
+
+class RecordFilter(BaseFilterBackend):
+    """Filter records by query parameters. Every parameter can be given
+    more than once to match any of the values, e.g.
+    ?languages=Greek&languages=Latin.
+
+    - area, region: the name of the area or region of the place
+    - category1, category2: the name of the primary or secondary category
+    - languages, scripts: the name of one of the languages or scripts
+    - century_min, century_max: one of the estimated centuries lies within
+      this range (inclusive); BCE centuries are negative
+    - sex_dedicator, sex_deceased: the value of the field
+    - publication: the identifier of the publication
+    - q: full-text search in the inscription, transcription, comments and
+      other texts (see search_query); results are ordered by rank
+
+    Many-to-many fields are filtered on the arrays in the search table
+    (see RecordSearch), so that no joins over the through tables are
+    needed, records are not duplicated and the GIN indexes are used.
+    """
+    # Query parameters by lookup on Record
+    lookups = {
+        'area': 'area__in',
+        'region': 'region__in',
+        'category1': 'category1__name__in',
+        'category2': 'category2__name__in',
+        'sex_dedicator': 'sex_dedicator__in',
+        'sex_deceased': 'sex_deceased__in',
+        'publication': 'publication__identifier__in',
+    }
+    # Query parameters by array lookup on the search table
+    array_lookups = {
+        'languages': 'search__languages__overlap',
+        'scripts': 'search__scripts__overlap',
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        for param, lookup in self.lookups.items():
+            values = [value for value in params.getlist(param) if value]
+            if values:
+                queryset = queryset.filter(**{lookup: values})
+        for param, lookup in self.array_lookups.items():
+            values = [value for value in params.getlist(param) if value]
+            if values:
+                queryset = queryset.filter(**{lookup: values})
+        centuries = {}
+        for param in ['century_min', 'century_max']:
+            value = params.get(param)
+            if value is None or value == '':
+                continue
+            try:
+                centuries[param] = int(value)
+            except ValueError:
+                raise ValidationError({param: 'Must be an integer.'})
+        if centuries:
+            # Give the range as the list of century numbers in it, limited
+            # to the centuries that exist
+            bounds = Century.objects.aggregate(
+                low=Min('century_number'), high=Max('century_number')
+            )
+            numbers: List[int] = []
+            if bounds['low'] is not None:
+                low = max(centuries.get('century_min', bounds['low']), bounds['low'])
+                high = min(centuries.get('century_max', bounds['high']), bounds['high'])
+                numbers = list(range(low, high + 1))
+            queryset = queryset.filter(
+                search__century_numbers__overlap=numbers
+            )
+        text = params.get('q')
+        if text:
+            query = search_query(text)
+            # ts_rank gives a real; cast it so that it can be used exactly
+            # in the position of a page cursor
+            queryset = queryset.filter(search__document=query).annotate(
+                rank=Cast(SearchRank(F('search__document'), query), FloatField())
+            ).order_by('-rank', 'pk')
+        return queryset
+
+
+# Kilometres per degree of latitude
+KM_PER_DEGREE = 111.32
+
+
+def parse_floats(request, param: str, count: int) -> Optional[List[float]]:
+    """Give a query parameter with comma-separated numbers as a list of
+    floats, or None if it is not given."""
+    value = request.query_params.get(param)
+    if not value:
+        return None
+    try:
+        numbers = [float(x) for x in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValidationError(
+            {param: f'Must be {count} comma-separated numbers.'}
+        )
+    return numbers
+
+
+class SpatialFilter(BaseFilterBackend):
+    """Filter by location, using the spatial index on Place.coordinates.
+    The view gives the path to the coordinates in its spatial_field
+    attribute.
+
+    - bbox=min_lon,min_lat,max_lon,max_lat: the location lies within the
+      bounding box
+    - near=lon,lat&radius_km=r: the location lies within r kilometres of
+      the given point
+
+    Radius queries first select the bounding box of the circle with the
+    index (&&), then check the distance on the sphere.
+    """
+    def filter_queryset(self, request, queryset, view):
+        field = getattr(view, 'spatial_field', 'coordinates')
+        bbox = parse_floats(request, 'bbox', 4)
+        if bbox:
+            queryset = queryset.filter(**{
+                f'{field}__bboverlaps': Polygon.from_bbox(bbox)
+            })
+        near = parse_floats(request, 'near', 2)
+        if near:
+            radius = parse_floats(request, 'radius_km', 1)
+            if not radius or radius[0] <= 0:
+                raise ValidationError(
+                    {'radius_km': 'A positive radius is needed with near.'}
+                )
+            lon, lat = near
+            radius_km = radius[0]
+            lat_delta = radius_km / KM_PER_DEGREE
+            # Longitude degrees get shorter towards the poles
+            cos_lat = cos(radians(min(abs(lat) + lat_delta, 90.0)))
+            lon_delta = 180.0 if cos_lat < 1e-6 else \
+                min(radius_km / (KM_PER_DEGREE * cos_lat), 180.0)
+            envelope = Polygon.from_bbox((
+                lon - lon_delta, max(lat - lat_delta, -90.0),
+                lon + lon_delta, min(lat + lat_delta, 90.0),
+            ))
+            queryset = queryset.filter(**{
+                f'{field}__bboverlaps': envelope,
+                f'{field}__distance_lte': (Point(lon, lat, srid=4326), D(km=radius_km)),
+            })
+        return queryset
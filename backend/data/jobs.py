@@ -0,0 +1,252 @@
+"""Background import jobs.
+
+Import jobs are created by uploading an input file in the admin, and are
+run by the run_import_jobs command. The queue is the ImportJob table, so
+several workers can run side by side without an external broker. Jobs
+are run one at a time, because imports on the same dataset would create
+duplicate places and lookup entries, or deadlock: a worker only claims
+the oldest queued job if no job is running, under an advisory lock that
+makes the other workers wait until the claim is committed.
+
+Imports run in a transaction, so their progress cannot be stored in the
+database until they end. While a job runs, its progress is kept in the
+'progress' cache, which is shared by the worker and the web processes.
+The worker also writes a heartbeat to the cache while it runs a job. If
+a worker dies, its transaction is rolled back; the job is marked as
+failed once its heartbeat is older than STALE_AFTER.
+"""
+from time import monotonic, time
+from typing import Any, Dict, List, Optional
+import logging
+import threading
+
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .bulk_import import (
+    ImportProgress, bulk_import_dataset, incremental_import_dataset,
+    replace_dataset,
+)
+from .models import ImportJob
+from .snapshot import rebuild_snapshot
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CACHE = 'progress'
+PROGRESS_TIMEOUT = 24 * 60 * 60
+# Warnings beyond this number are counted, but not stored
+MAX_WARNINGS = 1000
+# Seconds between heartbeats of a running job
+HEARTBEAT_INTERVAL = 30
+# Running jobs without a heartbeat for this many seconds are stale
+STALE_AFTER = 10 * 60
+# Key of the advisory lock that serializes claims of jobs; any number that
+# no other code uses as a lock key
+CLAIM_LOCK_KEY = 726_501
+
+
+def progress_key(job_id: int) -> str:
+    return f'import-job-progress:{job_id}'
+
+
+def heartbeat_key(job_id: int) -> str:
+    return f'import-job-heartbeat:{job_id}'
+
+
+class Heartbeat(threading.Thread):
+    """Writes the time to the progress cache at regular intervals while a
+    job runs, including during long stages that report no progress."""
+
+    def __init__(self, job: ImportJob):
+        super().__init__(daemon=True)
+        self.job_id = job.pk
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while True:
+            caches[PROGRESS_CACHE].set(
+                heartbeat_key(self.job_id), time(), PROGRESS_TIMEOUT
+            )
+            if self.stopped.wait(HEARTBEAT_INTERVAL):
+                return
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+class WarningCollector(logging.Handler):
+    """Collects the warnings that the import code logs"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.warnings: List[str] = []
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+        if len(self.warnings) < MAX_WARNINGS:
+            self.warnings.append(record.getMessage())
+
+
+class JobProgress(ImportProgress):
+    """Keeps track of the stages and rows of a running job, and publishes
+    them in the progress cache."""
+
+    def __init__(self, job: ImportJob, warnings: WarningCollector):
+        self.job = job
+        self.warnings = warnings
+        self.current_stage: Optional[str] = None
+        self.stage_started = monotonic()
+        self.stage_timings: Dict[str, float] = {}
+        self.rows_processed = 0
+
+    def stage(self, name: str) -> None:
+        self.end_stage()
+        self.current_stage = name
+        self.stage_started = monotonic()
+        self.publish()
+
+    def end_stage(self) -> None:
+        if self.current_stage is not None:
+            # A stage may occur more than once, e.g. in chunks
+            self.stage_timings[self.current_stage] = \
+                self.stage_timings.get(self.current_stage, 0) + \
+                monotonic() - self.stage_started
+        self.current_stage = None
+
+    def rows(self, count: int) -> None:
+        self.rows_processed += count
+        self.publish()
+
+    def publish(self) -> None:
+        caches[PROGRESS_CACHE].set(progress_key(self.job.pk), {
+            'stage': self.current_stage,
+            'rows_processed': self.rows_processed,
+            'stage_timings': self.stage_timings,
+            'warning_count': self.warnings.count,
+        }, PROGRESS_TIMEOUT)
+
+
+def job_progress(job: ImportJob) -> Dict[str, Any]:
+    """Give the progress of a job: from the progress cache while it runs,
+    otherwise from the job itself."""
+    progress = {
+        'stage': None,
+        'rows_processed': job.rows_processed,
+        'stage_timings': job.stage_timings,
+        'warning_count': len(job.warnings),
+    }
+    if job.status == ImportJob.RUNNING:
+        progress.update(caches[PROGRESS_CACHE].get(progress_key(job.pk)) or {})
+    elapsed = job.elapsed
+    progress['elapsed'] = elapsed
+    progress['rows_per_second'] = progress['rows_processed'] / elapsed \
+        if elapsed else None
+    return progress
+
+
+def claim_next_job() -> Optional[ImportJob]:
+    """Mark the oldest queued job as running and give it, or give None if
+    the queue is empty or another job is running."""
+    with transaction.atomic():
+        # Held until the claim is committed, so that other workers see it
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CLAIM_LOCK_KEY])
+        if ImportJob.objects.filter(status=ImportJob.RUNNING).exists():
+            return None
+        job = ImportJob.objects.filter(status=ImportJob.QUEUED) \
+            .order_by('created').first()
+        if job is None:
+            return None
+        job.status = ImportJob.RUNNING
+        job.started = timezone.now()
+        job.save(update_fields=['status', 'started'])
+    return job
+
+
+def run_job(job: ImportJob) -> None:
+    """Run a claimed job and store its outcome. Errors are stored in the
+    job rather than raised."""
+    warnings = WarningCollector()
+    progress = JobProgress(job, warnings)
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    # Catch the warnings of all modules of this app, such as models and
+    # bulk_import
+    app_logger = logging.getLogger(__package__)
+    app_logger.addHandler(warnings)
+    error: Optional[Exception] = None
+    try:
+        import_path = job.file.path
+        if job.mode == ImportJob.INCREMENTAL:
+            incremental_import_dataset(import_path, progress=progress)
+        elif job.mode == ImportJob.REPLACE:
+            replace_dataset(import_path, progress=progress)
+        else:
+            bulk_import_dataset(import_path, progress=progress)
+        progress.stage('rendering snapshot')
+        rebuild_snapshot()
+    except Exception as err:
+        error = err
+    finally:
+        app_logger.removeHandler(warnings)
+        heartbeat.stop()
+        progress.end_stage()
+    if error is None:
+        job.status = ImportJob.DONE
+    else:
+        # Logged after the handler is removed: the error is not a warning
+        # of the import
+        logger.error(f"Import job {job.pk} failed", exc_info=error)
+        job.status = ImportJob.FAILED
+        job.error = f"{type(error).__name__}: {error}"
+    job.finished = timezone.now()
+    job.rows_processed = progress.rows_processed
+    job.stage_timings = progress.stage_timings
+    job.warnings = warnings.warnings
+    if warnings.count > len(warnings.warnings):
+        job.warnings.append(
+            f"... and {warnings.count - len(warnings.warnings)} more warnings"
+        )
+    job.save()
+    caches[PROGRESS_CACHE].delete_many([
+        progress_key(job.pk), heartbeat_key(job.pk)
+    ])
+
+
+def fail_stale_jobs() -> int:
+    """Mark running jobs whose worker stopped sending heartbeats as failed,
+    and return their number. Their import was rolled back when the
+    connection of the worker was closed."""
+    count = 0
+    for job in ImportJob.objects.filter(status=ImportJob.RUNNING):
+        heartbeat = caches[PROGRESS_CACHE].get(heartbeat_key(job.pk))
+        if heartbeat is None:
+            # The worker may not have started the heartbeat yet
+            heartbeat = job.started.timestamp() if job.started else 0
+        if time() - heartbeat < STALE_AFTER:
+            continue
+        logger.warning(f"Import job {job.pk} is stale; marking it as failed")
+        # Unless it finished in the meantime
+        count += ImportJob.objects.filter(
+            pk=job.pk, status=ImportJob.RUNNING
+        ).update(
+            status=ImportJob.FAILED, finished=timezone.now(),
+            error='The worker stopped while running this job.'
+        )
+    return count
+
+
+def run_queued_jobs() -> int:
+    """Fail stale jobs, then run jobs until the queue is empty or a job of
+    another worker is running. Return the number of jobs run."""
+    fail_stale_jobs()
+    count = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
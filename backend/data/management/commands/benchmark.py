@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from data.benchmarks import (
+    LiveDatabaseError, append_history, benchmark_database, git_commit,
+    run_benchmarks,
+)
+
+
+class Command(BaseCommand):
+    help = '''
+    time the import, the Pleiades index, the API and the admin on synthetic
+    corpora, and add the results to a JSON history file. The benchmarks
+    run on a separate database, which is created like the test database
+    and dropped afterwards.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+            help='''Sizes of the synthetic corpora (default: 1000 10000
+            100000)''',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='''Number of runs; the fastest run is reported''',
+        )
+        parser.add_argument(
+            '--history',
+            default=str(Path(settings.BASE_DIR) / 'benchmark_history.json'),
+            help='''JSON file to add the results to''',
+        )
+        parser.add_argument(
+            '--no-history', action='store_true',
+            help='''Only show the results''',
+        )
+        parser.add_argument(
+            '--allow-live-db', action='store_true',
+            help='''Run on the configured database instead of a separate
+            one. The synthetic data is rolled back, but the dataset is
+            deleted and locked while the benchmarks run''',
+        )
+
+    def handle(self, rows, repeat=3, history=None, no_history=False,
+               allow_live_db=False, **options):
+        entry = {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'repeat': repeat,
+            'results': {},
+        }
+        database = nullcontext() if allow_live_db else benchmark_database()
+        with database:
+            for size in rows:
+                self.stdout.write(f"Benchmarking with {size} rows...")
+                try:
+                    results = run_benchmarks(
+                        size, repeat, allow_live_db=allow_live_db
+                    )
+                except LiveDatabaseError as err:
+                    raise CommandError(str(err))
+                for name, result in results.items():
+                    self.stdout.write(
+                        f"  {name}: {result['seconds'] * 1000:.1f} ms, "
+                        f"{result['queries']} queries"
+                    )
+                entry['results'][str(size)] = results
+        if not no_history:
+            append_history(Path(history), entry)
+            self.stdout.write(self.style.SUCCESS(f"Results added to {history}"))
@@ -7,8 +7,19 @@ class Command(BaseCommand):
     help = '''
     clear all data (to facilitate debugging)
     '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--truncate',
+            action='store_true',
+            help='''Empty all tables, including publications, with one
+            TRUNCATE statement instead of deleting row by row''',
+        )
     
-    def handle(self, **options):
+    def handle(self, truncate=False, **options):
+        if truncate:
+            models.truncate_dataset()
+            return
         models.Record.objects.all().delete()
         models.Area.objects.all().delete()
         models.Place.objects.all().delete()
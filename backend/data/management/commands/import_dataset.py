@@ -1,6 +1,11 @@
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
+from data.bulk_import import (
+    DatasetValidationError, bulk_import_dataset, incremental_import_dataset,
+    replace_dataset,
+)
 from data.models import import_dataset
+from data.snapshot import rebuild_snapshot
 
 class Command(BaseCommand):
     help = '''
@@ -11,6 +16,63 @@ class Command(BaseCommand):
             'import_path',
             help='''Provide the path and filename of the source data''',
         )
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument(
+            '--bulk',
+            action='store_true',
+            help='''Write all rows with bulk queries in one transaction
+            instead of row by row''',
+        )
+        mode.add_argument(
+            '--replace',
+            action='store_true',
+            help='''Replace all data with the sheet in one transaction, so
+            that the API keeps serving the old data until the import is
+            complete and valid''',
+        )
+        mode.add_argument(
+            '--incremental',
+            action='store_true',
+            help='''Only write the rows that changed since the last import,
+            and delete records that are no longer in the sheet''',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='''With --incremental, show what the import would change,
+            without changing anything''',
+        )
     
-    def handle(self, import_path, **options):
-        import_dataset(import_path)
+    def handle(self, import_path, bulk=False, replace=False, incremental=False, dry_run=False, **options):
+        if dry_run and not incremental:
+            raise CommandError("--dry-run can only be used with --incremental.")
+        if replace:
+            try:
+                count = replace_dataset(import_path)
+            except DatasetValidationError as err:
+                raise CommandError(f"{err}. The data was not changed.")
+            self.stdout.write(f"Replaced the dataset with {count} records.")
+        elif incremental:
+            diff = incremental_import_dataset(import_path, dry_run=dry_run)
+            self.stdout.write(
+                f"{len(diff.new)} new, {len(diff.changed)} changed, "
+                f"{len(diff.unchanged)} unchanged, {len(diff.deleted)} deleted "
+                f"records; {len(diff.changed_places)} changed places."
+            )
+            if options['verbosity'] > 1:
+                for label, sources in [
+                    ('New', diff.new), ('Changed', diff.changed),
+                    ('Deleted', diff.deleted),
+                    ('Changed place', diff.changed_places),
+                ]:
+                    for source in sources:
+                        self.stdout.write(f"{label}: {source}")
+            if dry_run or not (diff.new or diff.changed or diff.deleted
+                               or diff.changed_places):
+                return
+        elif bulk:
+            bulk_import_dataset(import_path)
+        else:
+            import_dataset(import_path)
+        # Render the API snapshot now rather than on the first request
+        rebuild_snapshot()
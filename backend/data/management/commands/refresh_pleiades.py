@@ -0,0 +1,31 @@
+from django.core.management import BaseCommand
+
+from data.models import Place
+from data.pleiades import pleiades_fetcher
+
+
+class Command(BaseCommand):
+    help = '''
+    download the latest Pleiades data if it changed, and update the
+    coordinates of places accordingly
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='''Rebuild the Pleiades index and check the coordinates of
+            all places, even if the Pleiades data did not change''',
+        )
+
+    def handle(self, force=False, **options):
+        changed = pleiades_fetcher.refresh(force=force)
+        if not changed and not force:
+            self.stdout.write(self.style.SUCCESS(
+                "Pleiades data is up to date; places are not updated."
+            ))
+            return
+        result = Place.objects.update_from_pleiades()
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated coordinates of {result.changed} places."
+        ))
@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from data.models import Record, RecordSearch
+
+
+class Command(BaseCommand):
+    help = '''
+    copy area and region from places to the denormalized fields of all
+    records, and fill the search table again
+    '''
+
+    def handle(self, **options):
+        count = Record.objects.resync_denormalized()
+        RecordSearch.objects.refresh()
+        self.stdout.write(self.style.SUCCESS(f"Resynced {count} records."))
@@ -0,0 +1,37 @@
+from time import sleep
+
+from django.core.management import BaseCommand
+
+from data.jobs import run_queued_jobs
+
+
+class Command(BaseCommand):
+    help = '''
+    run the import jobs that are uploaded in the admin. Several workers
+    can run at the same time, but jobs are run one at a time: while one
+    worker runs a job, the others wait.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='''Run the queued jobs and stop, instead of waiting for
+            new jobs''',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='''Seconds to wait before checking for new jobs
+            (default: 5)''',
+        )
+
+    def handle(self, once=False, interval=5, **options):
+        while True:
+            count = run_queued_jobs()
+            if count:
+                self.stdout.write(f"Ran {count} import jobs.")
+            if once:
+                return
+            sleep(interval)
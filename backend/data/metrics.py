@@ -0,0 +1,308 @@
+"""Performance metrics of requests.
+
+MetricsMiddleware measures the latency, the number and total time of SQL
+queries, the size of the response and the time spent in serializers of
+every request, and adds them to histograms per view. The histograms are
+kept in memory and are served in the Prometheus text format by MetricsView
+at /metrics. Each process keeps its own histograms, so with several worker
+processes every scrape only covers the worker that answered it.
+
+If the SLOW_REQUEST_THRESHOLD setting is a number of seconds, requests
+that take longer are logged as warnings, with their SQL queries.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (
+    100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000,
+)
+
+# Name: (help, buckets)
+HISTOGRAMS = {
+    'jhm_request_duration_seconds': (
+        'Time until the last byte of the response was sent',
+        DURATION_BUCKETS,
+    ),
+    'jhm_request_queries': (
+        'Number of SQL queries of a request', QUERY_COUNT_BUCKETS,
+    ),
+    'jhm_request_query_duration_seconds': (
+        'Total time of the SQL queries of a request', DURATION_BUCKETS,
+    ),
+    'jhm_response_size_bytes': ('Size of the response body', SIZE_BUCKETS),
+    'jhm_serializer_duration_seconds': (
+        'Time spent in serializers, for requests that use them',
+        DURATION_BUCKETS,
+    ),
+}
+
+# Queries beyond this number are counted, but not logged
+MAX_LOGGED_QUERIES = 100
+
+
+class Histogram:
+    """Counts observations in buckets with the given upper bounds."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # The last count is of observations above the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> Iterator[Tuple[str, int]]:
+        """Give the upper bound and the number of observations up to it for
+        each bucket, as Prometheus expects them."""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield format_value(bound), total
+        yield '+Inf', self.count
+
+
+def format_value(value: float) -> str:
+    return repr(float(value))
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    """Histograms of all views, and the number of requests per view and
+    status code."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.requests: Dict[Tuple[str, int], int] = {}
+
+    def observe(
+            self, view: str, status: int, values: Dict[str, float]
+    ) -> None:
+        """Add the values of a request, by histogram name."""
+        with self.lock:
+            self.requests[view, status] = \
+                self.requests.get((view, status), 0) + 1
+            for name, value in values.items():
+                histogram = self.histograms.get((name, view))
+                if histogram is None:
+                    histogram = Histogram(HISTOGRAMS[name][1])
+                    self.histograms[name, view] = histogram
+                histogram.observe(value)
+
+    def render(self) -> str:
+        """Give all metrics in the Prometheus text format."""
+        lines = [
+            '# HELP jhm_requests_total Number of requests',
+            '# TYPE jhm_requests_total counter',
+        ]
+        with self.lock:
+            for (view, status), count in sorted(self.requests.items()):
+                lines.append('jhm_requests_total{{view="{}",status="{}"}} {}'
+                             .format(escape_label(view), status, count))
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                views = sorted(
+                    view for (histogram_name, view) in self.histograms
+                    if histogram_name == name
+                )
+                for view in views:
+                    histogram = self.histograms[name, view]
+                    label = 'view="{}"'.format(escape_label(view))
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(
+                            f'{name}_bucket{{{label},le="{bound}"}} {count}'
+                        )
+                    lines.append(
+                        f'{name}_sum{{{label}}} {format_value(histogram.sum)}'
+                    )
+                    lines.append(f'{name}_count{{{label}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.requests.clear()
+
+
+metrics = Metrics()
+
+
+class RequestMetrics:
+    """Measurements of a single request. It is installed as an execute
+    wrapper of the database connection to measure the SQL queries."""
+
+    def __init__(self, log_queries: bool):
+        self.started = monotonic()
+        self.log_queries = log_queries
+        self.query_count = 0
+        self.query_seconds = 0.0
+        # SQL and duration, if queries are logged
+        self.queries: List[Tuple[str, float]] = []
+        self.serializer_seconds: Optional[float] = None
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        started = monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = monotonic() - started
+            self.query_count += 1
+            self.query_seconds += duration
+            if self.log_queries and len(self.queries) < MAX_LOGGED_QUERIES:
+                query = None
+                if not many:
+                    query = context['connection'].ops.last_executed_query(
+                        context['cursor'], sql, params
+                    )
+                self.queries.append((query or sql, duration))
+
+    def values(self, duration: float, size: Optional[int]) -> Dict[str, float]:
+        values = {
+            'jhm_request_duration_seconds': duration,
+            'jhm_request_queries': self.query_count,
+            'jhm_request_query_duration_seconds': self.query_seconds,
+        }
+        if size is not None:
+            values['jhm_response_size_bytes'] = size
+        if self.serializer_seconds is not None:
+            values['jhm_serializer_duration_seconds'] = self.serializer_seconds
+        return values
+
+
+_current_request: ContextVar[Optional[RequestMetrics]] = \
+    ContextVar('current_request_metrics', default=None)
+
+
+@contextmanager
+def serializer_timer():
+    """Count the time spent in the block as serializer time of the current
+    request. Nested blocks are only counted once."""
+    request_metrics = _current_request.get()
+    if request_metrics is None or request_metrics.serializing:
+        yield
+        return
+    request_metrics.serializing = True
+    started = monotonic()
+    try:
+        yield
+    finally:
+        request_metrics.serializing = False
+        request_metrics.serializer_seconds = \
+            (request_metrics.serializer_seconds or 0) + monotonic() - started
+
+
+def view_name(request) -> str:
+    """Give the label of the view that handled a request: the class and
+    action of API viewsets, the name of other named URLs (such as
+    admin:data_record_changelist), or the name of the view."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = match.func
+    actions = getattr(view, 'actions', None)
+    if actions:
+        action = actions.get(request.method.lower(), request.method.lower())
+        return f'{view.cls.__name__}.{action}'
+    if match.url_name:
+        return match.view_name
+    view = getattr(view, 'cls', None) or getattr(view, 'view_class', view)
+    return view.__name__
+
+
+def slow_request_threshold() -> Optional[float]:
+    return getattr(settings, 'SLOW_REQUEST_THRESHOLD', None)
+
+
+class MetricsMiddleware:
+    """Adds the measurements of every request to the metrics. Streaming
+    responses are measured until their last chunk is sent."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = RequestMetrics(
+            log_queries=slow_request_threshold() is not None
+        )
+        token = _current_request.set(request_metrics)
+        try:
+            with connection.execute_wrapper(request_metrics):
+                response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        view = view_name(request)
+        if not response.streaming:
+            self.record(request, response, view, request_metrics,
+                        len(response.content))
+        elif not getattr(response, 'is_async', False):
+            # The content must be taken before it is replaced
+            response.streaming_content = self.measure_stream(
+                request, response, view, request_metrics,
+                iter(response.streaming_content)
+            )
+        else:
+            self.record(request, response, view, request_metrics, None)
+        return response
+
+    def measure_stream(self, request, response, view, request_metrics,
+                       chunks):
+        size = 0
+        try:
+            while True:
+                # Queries of lazy querysets run while the stream is read
+                with connection.execute_wrapper(request_metrics):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.record(request, response, view, request_metrics, size)
+
+    def record(self, request, response, view: str,
+               request_metrics: RequestMetrics, size: Optional[int]) -> None:
+        duration = monotonic() - request_metrics.started
+        metrics.observe(
+            view, response.status_code, request_metrics.values(duration, size)
+        )
+        threshold = slow_request_threshold()
+        if threshold is None or duration < threshold:
+            return
+        lines = [
+            'Slow request: {} {} ({}) took {:.3f} s, with {} queries in '
+            '{:.3f} s'.format(
+                request.method, request.get_full_path(), view, duration,
+                request_metrics.query_count, request_metrics.query_seconds,
+            )
+        ]
+        for sql, query_duration in request_metrics.queries:
+            lines.append(f'[{query_duration:.3f} s] {sql}')
+        if request_metrics.query_count > len(request_metrics.queries):
+            lines.append('... and {} more queries'.format(
+                request_metrics.query_count - len(request_metrics.queries)
+            ))
+        logger.warning('\n'.join(lines))
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0009_publication_record_location_in_publication_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='century',
+            name='century_number',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['area', 'region'], name='record_area_region_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['region'], name='record_region_idx'),
+        ),
+    ]
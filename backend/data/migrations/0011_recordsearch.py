@@ -0,0 +1,57 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Copy of the query of RecordSearch.objects.refresh at this migration; the
+# search document is added in the next migration
+FILL_RECORD_SEARCH = """
+INSERT INTO data_recordsearch
+    (record_id, languages, scripts, century_numbers, coordinates)
+SELECT data_record.id,
+    ARRAY(SELECT choice.name FROM data_record_languages through
+          JOIN data_language choice ON choice.id = through.language_id
+          WHERE through.record_id = data_record.id
+          AND choice.name IS NOT NULL ORDER BY choice.name),
+    ARRAY(SELECT choice.name FROM data_record_scripts through
+          JOIN data_script choice ON choice.id = through.script_id
+          WHERE through.record_id = data_record.id
+          AND choice.name IS NOT NULL ORDER BY choice.name),
+    ARRAY(SELECT choice.century_number
+          FROM data_record_estimated_centuries through
+          JOIN data_century choice ON choice.id = through.century_id
+          WHERE through.record_id = data_record.id
+          AND choice.century_number IS NOT NULL
+          ORDER BY choice.century_number),
+    place.coordinates
+FROM data_record
+LEFT JOIN data_place place ON place.id = data_record.place_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0010_record_indexes_century_number_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordSearch',
+            fields=[
+                ('record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search', serialize=False, to='data.record')),
+                ('languages', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), default=list, size=None)),
+                ('scripts', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), default=list, size=None)),
+                ('century_numbers', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('coordinates', django.contrib.gis.db.models.fields.PointField(blank=True, null=True, srid=4326)),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['languages'], name='recordsearch_languages_idx'), django.contrib.postgres.indexes.GinIndex(fields=['scripts'], name='recordsearch_scripts_idx'), django.contrib.postgres.indexes.GinIndex(fields=['century_numbers'], name='recordsearch_centuries_idx')],
+            },
+        ),
+        migrations.RunSQL(FILL_RECORD_SEARCH, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+import django.contrib.postgres.search
+from django.db import migrations
+import django.db.models.functions.text
+
+
+# Copy of the search document of RecordSearch.objects.refresh at this
+# migration
+FILL_SEARCH_DOCUMENT = """
+UPDATE data_recordsearch
+SET document =
+    setweight(to_tsvector('simple', data_record.inscription), 'A') ||
+    setweight(to_tsvector('simple', data_record.transcription), 'A') ||
+    setweight(to_tsvector('simple', data_record.comments), 'B') ||
+    setweight(to_tsvector('simple', data_record.mentioned_placenames), 'C') ||
+    setweight(to_tsvector('simple', data_record.religious_profession), 'C') ||
+    setweight(to_tsvector('simple', data_record.symbol), 'C')
+FROM data_record
+WHERE data_record.id = data_recordsearch.record_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0011_recordsearch'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='recordsearch',
+            name='document',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.RunSQL(FILL_SEARCH_DOCUMENT, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='recordsearch',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['document'], name='recordsearch_document_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='place',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='place_name_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('source'), name='gin_trgm_ops'), name='record_source_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('mentioned_placenames'), name='gin_trgm_ops'), name='record_placenames_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('religious_profession'), name='gin_trgm_ops'), name='record_profession_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('symbol'), name='gin_trgm_ops'), name='record_symbol_trgm_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('data', '0013_place_content_hash_record_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='imports/', validators=[django.core.validators.FileExtensionValidator(['xlsx'])])),
+                ('mode', models.CharField(choices=[('bulk', 'Add and update records'), ('incremental', 'Only write changes, delete records that are not in the file'), ('replace', 'Replace all data')], default='bulk', max_length=20)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', editable=False, max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('finished', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('rows_processed', models.IntegerField(default=0, editable=False)),
+                ('stage_timings', models.JSONField(default=dict, editable=False)),
+                ('warnings', models.JSONField(default=list, editable=False)),
+                ('error', models.TextField(blank=True, default='', editable=False)),
+                ('created_by', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
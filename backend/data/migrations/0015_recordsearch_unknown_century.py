@@ -0,0 +1,31 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+# Copy of the query of RecordSearch.objects.refresh at this migration
+FILL_UNKNOWN_CENTURY = """
+UPDATE data_recordsearch
+SET unknown_century = EXISTS(
+    SELECT FROM data_record_estimated_centuries through
+    JOIN data_century century ON century.id = through.century_id
+    WHERE through.record_id = data_recordsearch.record_id
+    AND century.century_number IS NULL
+)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0014_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordsearch',
+            name='unknown_century',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunSQL(FILL_UNKNOWN_CENTURY, migrations.RunSQL.noop),
+    ]
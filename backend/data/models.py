@@ -1,14 +1,25 @@
-from typing import Callable, List, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, Union
 import logging
 
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchQuery, SearchVectorField
+from django.core.validators import FileExtensionValidator
+from django.db import connection, models, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Upper
+from django.utils import timezone
 from django.contrib.gis.db import models as gismodels
 from django.contrib.gis.geos import Point
 
 import openpyxl
 
 from .pleiades import pleiades_fetcher
-from .utils import to_decimal
+from .snapshot import invalidate_snapshot_on_commit
+from .utils import content_hash, location_index
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,64 @@ def normalize_sex(input_str: str) -> List[str]:
     return [SEX_REPLACEMENTS.get(x.strip(), x) for x in items]
 
 
+def normalize_century(century: str) -> str:
+    """Turn a century as written in the input file into the name of a
+    Century. BCE centuries are written with a trailing minus sign."""
+    return '-' + century[:-1] if century.endswith('-') else century
+
+
+def parse_choice_value(
+        value: Any, transformer: Optional[Callable[[str], str]] = None
+) -> str:
+    """Give the name of a choice field entry as given in the input file."""
+    value = str(value)
+    if transformer:
+        value = transformer(value)
+    return value.strip()
+
+
+def parse_choice_values(
+        value: Any, splitter: str,
+        transformer: Optional[Callable[[str], str]] = None
+) -> List[str]:
+    """Give the names of a list of choice field entries as given in the
+    input file, such as 'Greek|Hebrew'."""
+    return [
+        parse_choice_value(x, transformer) for x in str(value).split(splitter)
+    ]
+
+
+def record_fields_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Give the values of the plain (non-relational) fields of a record as
+    given in a row of the input file, including the content hash of the
+    row. The sex fields are only included if they are filled in."""
+    fields = {
+        'content_hash': content_hash(row),
+        'period': row['period'] or '',
+        'inscriptions_count': row['inscriptions-count'] if isinstance(row['inscriptions-count'], int) else 0,
+        'mentioned_placenames': row['mentioned placenames'] or '',
+        'religious_profession': row['mention religious profession'] or '',
+        'symbol': row['mention religious symbol'] or '',
+        'comments': row['comments'] or '',
+        'inscription': row['inscription'] or '',
+        'transcription': row['transcription '] or '',
+    }
+    sex_dedicator_text = row['sexe dedicator epitaph (male/female/child)']
+    if sex_dedicator_text:
+        fields['sex_dedicator'] = ', '.join(normalize_sex(sex_dedicator_text))
+    sex_deceased_text = row['sexe of deceased (male/female/child)']
+    if sex_deceased_text:
+        fields['sex_deceased'] = ', '.join(normalize_sex(sex_deceased_text))
+    return fields
+
+
+def place_content_hash(row: Dict[str, Any], locations) -> str:
+    """Give the content hash of the data in a row from which the
+    coordinates of its place are determined: the Pleiades id and the
+    coordinates in the sheet with location info."""
+    return content_hash([row['pleiades'], locations.get(row['own id '])])
+
+
 class Area(models.Model):
     name = models.CharField(max_length=100)
 
@@ -42,8 +111,20 @@ class Region(models.Model):
         return self.name
 
 
+class PleiadesUpdateResult(NamedTuple):
+    """Numbers of places by outcome of PlaceManager.update_from_pleiades"""
+    changed: int
+    unchanged: int
+    missing: int
+    no_coordinates: int
+    no_pleiades_id: int
+
+
 class PlaceManager(models.Manager):
-    def create_place(self, row_dict, location_sheet):
+    def create_place(self, row_dict, locations):
+        """Give the place of a row from the input file, creating it if it
+        does not yet exist. locations is the index of the sheet with
+        location info, as given by utils.location_index."""
         placename = row_dict['placename']
         if placename is None:
             # No placename defined; do not create anything and return None
@@ -77,11 +158,60 @@ class PlaceManager(models.Manager):
                     "Taking information from document instead."
                 )
         if coordinates is None:
-            coordinates = place.fetch_from_document(location_sheet, row_dict['own id '])
+            coordinates = place.fetch_from_document(locations, row_dict['own id '])
         place.coordinates = coordinates
+        place.content_hash = place_content_hash(row_dict, locations)
         place.save()
         return place
 
+    def update_from_pleiades(self, queryset=None) -> "PleiadesUpdateResult":
+        """Set the coordinates of all places with a Pleiades id (or of the
+        given queryset) to the reprPoint in the Pleiades data, if it
+        differs. All Pleiades ids are resolved in one pass over the index,
+        and changed places are written with a single bulk update."""
+        if queryset is None:
+            queryset = self.get_queryset()
+        places = list(queryset.only('pk', 'pleiades_id', 'coordinates'))
+        pleiades_data = pleiades_fetcher.fetch_many(
+            place.pleiades_id for place in places if place.pleiades_id
+        )
+        counts = dict.fromkeys(PleiadesUpdateResult._fields, 0)
+        changed = []
+        for place in places:
+            if not place.pleiades_id:
+                counts['no_pleiades_id'] += 1
+                continue
+            if place.pleiades_id not in pleiades_data:
+                counts['missing'] += 1
+                continue
+            reprpoint = pleiades_data[place.pleiades_id]['reprPoint']
+            if not reprpoint:
+                counts['no_coordinates'] += 1
+                continue
+            # Point expects first x, then y
+            coordinates = Point(float(reprpoint[0]), float(reprpoint[1]))
+            if place.coordinates is None or \
+                    place.coordinates.coords != coordinates.coords:
+                place.coordinates = coordinates
+                changed.append(place)
+            else:
+                counts['unchanged'] += 1
+        self.bulk_update(changed, ['coordinates'], batch_size=1000)
+        if changed:
+            # Bulk updates do not send signals
+            invalidate_snapshot_on_commit()
+            RecordSearch.objects.refresh(
+                Record.objects.filter(place__in=changed)
+            )
+        counts['changed'] = len(changed)
+        result = PleiadesUpdateResult(**counts)
+        if result.missing or result.no_coordinates:
+            logger.warning(
+                f"{result.missing} Pleiades objects not found, "
+                f"{result.no_coordinates} found but without coordinates."
+            )
+        return result
+
 class Place(models.Model):
     name = models.CharField(max_length=100)
     area = models.ForeignKey(
@@ -92,6 +222,9 @@ class Place(models.Model):
     )
     coordinates = gismodels.PointField(null=True, blank=True)
     pleiades_id = models.IntegerField(null=True, blank=True)
+    # Hash of the data in the input file from which the coordinates were
+    # taken, see place_content_hash
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
         
     objects = PlaceManager()
     records: models.Manager["Record"]
@@ -127,28 +260,72 @@ class Place(models.Model):
             )
             return None
     
-    def fetch_from_document(self, location_sheet, identifier) -> Optional[Point]:
-        ''' return coordinates from sheet with location info:
-        latitute in column 4, longitude in column 5
+    def fetch_from_document(self, locations, identifier) -> Optional[Point]:
+        ''' return coordinates from the index of the sheet with location
+        info, as given by utils.location_index
         '''
-        coordinates = next(((to_decimal(row[4]), to_decimal(row[5])) for row in location_sheet.values if row[0] == identifier), None)
+        coordinates = locations.get(identifier)
         if coordinates is not None:
             # Point expects first x (longitude), then y (latitude)
             return Point(coordinates[1], coordinates[0])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember area and region as stored, to see if they change on save
+        instance._stored_location = (
+            instance.__dict__.get('area_id'), instance.__dict__.get('region_id')
+        )
+        # Likewise the coordinates, which are copied to the search table
+        instance._stored_coordinates = instance._loaded_coordinates()
+        return instance
+
+    def _loaded_coordinates(self) -> Optional[Tuple[float, ...]]:
+        # Deferred coordinates are not loaded (and not saved)
+        if 'coordinates' not in self.__dict__ or self.coordinates is None:
+            return None
+        return self.coordinates.coords
+
+    def coordinates_changed(self) -> bool:
+        """Whether the coordinates differ from those stored in the
+        database."""
+        return self._loaded_coordinates() != \
+            getattr(self, '_stored_coordinates', None)
+
+    def denormalized_fields(self) -> Dict[str, Optional[str]]:
+        """Give the values of the fields of related records that are copied
+        from this place."""
+        return {
+            'area': self.area.name if self.area else None,
+            'region': self.region.name if self.region else None,
+        }
+
     def save(self, *args, **kwargs) -> None:
         super().save(*args, **kwargs)
-        # Run save also on related records to update their region and area
-        for record in self.records.all():
-            record.save()
+        # Update the region and area of related records with a single query,
+        # but only if they changed
+        location = (self.area_id, self.region_id)
+        if location != getattr(self, '_stored_location', None):
+            self.records.update(**self.denormalized_fields())
+            self._stored_location = location
+        # The search table is refreshed by a signal, see signals.py
+        self._stored_coordinates = self._loaded_coordinates()
 
     class Meta:
         ordering = ["name"]
+        indexes = [
+            # Trigram index for the substring filter on place names in the
+            # admin (__icontains)
+            GinIndex(OpClass(Upper('name'), name='gin_trgm_ops'), name='place_name_trgm_idx'),
+        ]
     
 class RecordManager(models.Manager):
-    def create_record(self, row, place) -> Optional['Record']:
+    def create_record(
+            self, row, place, choice_cache: Optional["ChoiceFieldCache"] = None
+    ) -> Optional['Record']:
         """ given a row from the input file and a place,
-        return a SettlementEvidence instance """
+        return a SettlementEvidence instance. Pass a ChoiceFieldCache
+        to avoid querying choice fields for every row. """
         if row['id'] is None or row['id'] == '':
             logger.warning('Ignoring row with empty id column')
             return None
@@ -158,54 +335,57 @@ class RecordManager(models.Manager):
         record.place = place
 
         # Apply simple string or integer mappings
-        record.period = row['period'] or ''
-        record.inscriptions_count = row['inscriptions-count'] if isinstance(row['inscriptions-count'], int) else 0
-        record.mentioned_placenames = row['mentioned placenames'] or ''
-        record.religious_profession = row['mention religious profession'] or ''
-        record.symbol = row['mention religious symbol'] or ''
-        record.comments = row['comments'] or ''
-        record.inscription = row['inscription'] or ''
-        record.transcription = row['transcription '] or ''
-
-        sex_dedicator_text = row['sexe dedicator epitaph (male/female/child)']
-        if sex_dedicator_text:
-            record.sex_dedicator = ', '.join(normalize_sex(sex_dedicator_text))
-        sex_deceased_text = row['sexe of deceased (male/female/child)']
-        if sex_deceased_text:
-            record.sex_deceased = ', '.join(normalize_sex(sex_deceased_text))
+        for field, value in record_fields_from_row(row).items():
+            setattr(record, field, value)
 
         # Apply mappings for which a single objects is selected or created
         category1text = row['category 1']
         if category1text:
-            record.category1 = PrimaryCategory.objects.create_record(row['category 1'])
+            record.category1 = PrimaryCategory.objects.create_record(
+                row['category 1'], cache=choice_cache
+            )
         category2text = row['category 2']
         if category2text:
-            record.category2 = SecondaryCategory.objects.create_record(row['category 2'])
+            record.category2 = SecondaryCategory.objects.create_record(
+                row['category 2'], cache=choice_cache
+            )
 
         # Same, but with multiple objects
         language_text = row['language']
         if language_text:
             record.languages.set(Language.objects.create_records(
                 language_text,
-                '|'
+                '|',
+                cache=choice_cache
             ))
         script_text = row['script']
         if script_text:
             record.scripts.set(Script.objects.create_records(
                 script_text,
-                '|'
+                '|',
+                cache=choice_cache
             ))
         centuries_text = row['centuries']
         if centuries_text:
             record.estimated_centuries.set(Century.objects.create_records(
                 centuries_text,
                 '|',
-                (lambda x: '-' + x[:-1] if x.endswith('-') else x)
+                normalize_century,
+                cache=choice_cache
             ))
 
         record.save()
         return record
 
+    def resync_denormalized(self) -> int:
+        """Copy area and region from the places of all records with a
+        single query. Return the number of records."""
+        places = Place.objects.filter(pk=OuterRef('place_id'))
+        return self.get_queryset().update(
+            area=Subquery(places.values('area__name')[:1]),
+            region=Subquery(places.values('region__name')[:1]),
+        )
+
 
 class Record(models.Model):
     FEMALE = "female"
@@ -245,12 +425,18 @@ class Record(models.Model):
     # Non-editable fields for quick lookup
     area = models.CharField(max_length=100, editable=False, null=True)
     region = models.CharField(max_length=100, editable=False, null=True)
+    # Hash of the row in the input file, to see if it changed on re-import
+    content_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
 
     objects = RecordManager()
 
     def save(self, *args, **kwargs) -> None:
-        self.area = str(self.place.area) if self.place else None
-        self.region = str(self.place.region) if self.place else None
+        if self.place:
+            fields = self.place.denormalized_fields()
+            self.area = fields['area']
+            self.region = fields['region']
+        else:
+            self.area = self.region = None
         return super().save(*args, **kwargs)
 
     def __str__(self):
@@ -258,26 +444,240 @@ class Record(models.Model):
         name = self.place.name if self.place and self.place.name else "(unknown place)"
         return '{} {}'.format(source, name)
 
+    class Meta:
+        indexes = [
+            # For filtering on area, or area and region
+            models.Index(fields=['area', 'region'], name='record_area_region_idx'),
+            models.Index(fields=['region'], name='record_region_idx'),
+            # Trigram indexes for the substring filters of the admin, which
+            # compare in upper case (__icontains)
+            GinIndex(OpClass(Upper('source'), name='gin_trgm_ops'), name='record_source_trgm_idx'),
+            GinIndex(OpClass(Upper('mentioned_placenames'), name='gin_trgm_ops'), name='record_placenames_trgm_idx'),
+            GinIndex(OpClass(Upper('religious_profession'), name='gin_trgm_ops'), name='record_profession_trgm_idx'),
+            GinIndex(OpClass(Upper('symbol'), name='gin_trgm_ops'), name='record_symbol_trgm_idx'),
+        ]
+
+
+# Text search configuration of the search document. The texts are in
+# several, mostly ancient, languages, so words are not stemmed.
+SEARCH_CONFIG = 'simple'
+
+# Weights of the fields of records in the search document
+SEARCH_WEIGHTS = {
+    'inscription': 'A',
+    'transcription': 'A',
+    'comments': 'B',
+    'mentioned_placenames': 'C',
+    'religious_profession': 'C',
+    'symbol': 'C',
+}
+
+
+def search_query(text: str) -> SearchQuery:
+    """Give the full-text query for text, which is written like in a web
+    search engine: words, "quoted phrases", OR, and -excluded words."""
+    return SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+
+
+# Set while RecordSearchManager.defer_refresh is active
+_refresh_deferred: ContextVar[bool] = \
+    ContextVar('search_refresh_deferred', default=False)
+
+
+class RecordSearchManager(models.Manager):
+    def refresh(
+            self,
+            record_ids: Optional[Union[Iterable[int], models.QuerySet]] = None
+    ) -> None:
+        """Fill the search table from the records, or only the rows of the
+        given records, with one DELETE and one INSERT ... SELECT. A
+        queryset of records is used as a subquery, so that its ids need
+        not be fetched first. Saves of records and places call this
+        through signals (see signals.py); it needs to be called after
+        changes that bypass signals, such as bulk queries.
+
+        The migrations that create the table fill it with a copy of this
+        query, which needs to be kept in sync with it."""
+        record = Record._meta.db_table
+        # Condition on the record id of both queries
+        condition = None
+        params: List[Any] = []
+        if isinstance(record_ids, models.QuerySet):
+            subquery, subquery_params = \
+                record_ids.values('pk').query.sql_with_params()
+            condition = f'IN ({subquery})'
+            params.extend(subquery_params)
+        elif record_ids is not None:
+            record_ids = list(record_ids)
+            if not record_ids:
+                return
+            condition = '= ANY(%s)'
+            params.append(record_ids)
+        where = f'WHERE {record}.id {condition}' if condition else ''
+
+        def names(field: str, order_by: str) -> str:
+            through = getattr(Record, field).through
+            model = Record._meta.get_field(field).related_model
+            column = f'{model._meta.model_name}_id'
+            return (
+                f'ARRAY(SELECT choice.{order_by} '
+                f'FROM {through._meta.db_table} through '
+                f'JOIN {model._meta.db_table} choice '
+                f'ON choice.id = through.{column} '
+                f'WHERE through.record_id = {record}.id '
+                f'AND choice.{order_by} IS NOT NULL '
+                f'ORDER BY choice.{order_by})'
+            )
+
+        document = ' || '.join(
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', {record}.{field}), '{weight}')"
+            for field, weight in SEARCH_WEIGHTS.items()
+        )
+
+        century_through = Record.estimated_centuries.through._meta.db_table
+        unknown_century = (
+            f'EXISTS(SELECT FROM {century_through} through '
+            f'JOIN {Century._meta.db_table} century '
+            'ON century.id = through.century_id '
+            f'WHERE through.record_id = {record}.id '
+            'AND century.century_number IS NULL)'
+        )
+
+        search = self.model._meta.db_table
+        # Without a savepoint of its own, an error rolls back the enclosing
+        # transaction, if any
+        with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+            if condition is None:
+                cursor.execute(f'DELETE FROM {search}')
+            else:
+                cursor.execute(
+                    f'DELETE FROM {search} WHERE record_id {condition}',
+                    params
+                )
+            cursor.execute(
+                f'INSERT INTO {search} '
+                '(record_id, languages, scripts, century_numbers, '
+                'unknown_century, coordinates, document) '
+                f'SELECT {record}.id, '
+                f'{names("languages", "name")}, '
+                f'{names("scripts", "name")}, '
+                f'{names("estimated_centuries", "century_number")}, '
+                f'{unknown_century}, '
+                f'place.coordinates, {document} '
+                f'FROM {record} '
+                f'LEFT JOIN {Place._meta.db_table} place '
+                f'ON place.id = {record}.place_id {where}',
+                params
+            )
+
+    @contextmanager
+    def defer_refresh(self) -> Iterator[None]:
+        """Make the signals of saves in the block leave the search table
+        alone, and refresh the whole table once when the block ends. For
+        imports that save records one by one, which would otherwise
+        refresh each record several times."""
+        token = _refresh_deferred.set(True)
+        try:
+            yield
+        finally:
+            _refresh_deferred.reset(token)
+        self.refresh()
+
+    def refresh_deferred(self) -> bool:
+        """Whether the signals should leave the search table alone"""
+        return _refresh_deferred.get()
+
+
+class RecordSearch(models.Model):
+    """Denormalized copy of the many-to-many fields and the location of
+    each record, so that records can be filtered on them without joining
+    five tables. The arrays have GIN indexes, for lookups such as
+    languages__overlap; the coordinates have a spatial index. document is
+    the full-text search vector of the texts of the record (see
+    SEARCH_WEIGHTS), with a GIN index. The table is maintained with
+    RecordSearch.objects.refresh."""
+    record = models.OneToOneField(
+        Record, primary_key=True, on_delete=models.CASCADE,
+        related_name='search'
+    )
+    languages = ArrayField(models.CharField(max_length=255), default=list)
+    scripts = ArrayField(models.CharField(max_length=255), default=list)
+    century_numbers = ArrayField(models.IntegerField(), default=list)
+    # Whether one of the estimated centuries has no number (is unknown)
+    unknown_century = models.BooleanField(default=False)
+    coordinates = gismodels.PointField(null=True, blank=True)
+    document = SearchVectorField(null=True)
+
+    objects = RecordSearchManager()
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['languages'], name='recordsearch_languages_idx'),
+            GinIndex(fields=['scripts'], name='recordsearch_scripts_idx'),
+            GinIndex(
+                fields=['century_numbers'], name='recordsearch_centuries_idx'
+            ),
+            GinIndex(fields=['document'], name='recordsearch_document_idx'),
+        ]
+
+
+class ChoiceFieldCache:
+    """Import-scoped lookup from name to instance for all choice field
+    models. The existing entries of a model are loaded with one query the
+    first time the model is used; entries that do not yet exist are
+    created in batches."""
+
+    def __init__(self):
+        self._entries: Dict[Type["BaseChoiceField"], Dict[str, "BaseChoiceField"]] = {}
+
+    def _get_entries(
+            self, model: Type["BaseChoiceField"]
+    ) -> Dict[str, "BaseChoiceField"]:
+        if model not in self._entries:
+            self._entries[model] = {
+                entry.name: entry for entry in model.objects.all()
+            }
+        return self._entries[model]
+
+    def get_many(
+            self, model: Type["BaseChoiceField"], names: Iterable[str]
+    ) -> List["BaseChoiceField"]:
+        """Give the entries with the given names, creating all missing
+        entries with a single query."""
+        names = list(names)
+        entries = self._get_entries(model)
+        missing = [model(name=name) for name in dict.fromkeys(names)
+                   if name not in entries]
+        for entry in missing:
+            if isinstance(entry, Century):
+                entry.update_century_number()
+        for entry in model.objects.bulk_create(missing):
+            entries[entry.name] = entry
+        return [entries[name] for name in names]
+
+    def get(self, model: Type["BaseChoiceField"], name: str) -> "BaseChoiceField":
+        return self.get_many(model, [name])[0]
+
 
 class ChoiceFieldManager(models.Manager):
     def create_records(
-            self, value: str, splitter: str, transformer: Optional[Callable] = None
+            self, value: str, splitter: str, transformer: Optional[Callable] = None,
+            cache: Optional[ChoiceFieldCache] = None
     ) -> List["BaseChoiceField"]:
-        value = str(value)
-        entries = value.split(splitter)
+        names = parse_choice_values(value, splitter, transformer)
+        if cache:
+            return cache.get_many(self.model, names)
         # Return a list of records by applying create_record() to each entry.
-        return [self.create_record(x, transformer) for x in entries]
+        return [self.create_record(x) for x in names]
 
     def create_record(
-            self, value: str, transformer: Optional[Callable[[str], str]] = None
+            self, value: str, transformer: Optional[Callable[[str], str]] = None,
+            cache: Optional[ChoiceFieldCache] = None
     ) -> "BaseChoiceField":
-        value = str(value)
-        if transformer:
-            value = transformer(value)
-        value = value.strip()
+        value = parse_choice_value(value, transformer)
+        if cache:
+            return cache.get(self.model, value)
         record, _ = self.model.objects.get_or_create(name=value)
-        record.name = value
-        record.save()
         return record
 
 
@@ -318,7 +718,7 @@ class Century(BaseChoiceField):
     # The century is represented as a string that might be either a (negative
     # or positive) number or the word "unknown".
 
-    century_number = models.IntegerField(null=True, blank=True, editable=False)
+    century_number = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
     """The century as a number, for sorting purposes. Automatically generated."""
 
     @classmethod
@@ -330,13 +730,17 @@ class Century(BaseChoiceField):
         else:
             return int(century)
 
-    def save(self, *args, **kwargs) -> None:
+    def update_century_number(self) -> None:
+        """Set century_number from the name, if the name is valid."""
         try:
             number = self._to_number(self.name)
         except ValueError:
             pass
         else:
             self.century_number = number
+
+    def save(self, *args, **kwargs) -> None:
+        self.update_century_number()
         return super().save(*args, **kwargs)
 
     def __str__(self) -> str:
@@ -358,16 +762,76 @@ class Publication(models.Model):
         return self.identifier
 
 
-def import_dataset(input_file):
-    wb = openpyxl.load_workbook(filename=input_file)
-    sheet = wb['Data JewishMigration']
-    sheet2 = wb['ID settlements without Pleiades']
+class ImportJob(models.Model):
+    """An import of an uploaded input file, which is run in the background
+    by the run_import_jobs command (see jobs.py). While the job runs, its
+    progress is kept in the progress cache; when it ends, it is stored in
+    the fields of the job."""
+    BULK = 'bulk'
+    INCREMENTAL = 'incremental'
+    REPLACE = 'replace'
+    MODE_CHOICES = [
+        (BULK, "Add and update records"),
+        (INCREMENTAL, "Only write changes, delete records that are not in the file"),
+        (REPLACE, "Replace all data"),
+    ]
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    file = models.FileField(upload_to='imports/', validators=[FileExtensionValidator(['xlsx'])])
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default=BULK)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, editable=False)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+    rows_processed = models.IntegerField(default=0, editable=False)
+    # Seconds by stage, in the order of the stages
+    stage_timings = models.JSONField(default=dict, editable=False)
+    warnings = models.JSONField(default=list, editable=False)
+    error = models.TextField(blank=True, default='', editable=False)
+
+    def __str__(self):
+        return f"Import of {self.file.name} ({self.get_status_display().lower()})"
+
+    @property
+    def elapsed(self) -> Optional[float]:
+        """Seconds from the start to the end of the job, so far"""
+        if self.started is None:
+            return None
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        elapsed = self.elapsed
+        if not elapsed:
+            return None
+        return self.rows_processed / elapsed
+
+    class Meta:
+        ordering = ['-created']
+
+
+def iter_data_rows(sheet) -> Iterator[Dict[str, Any]]:
+    """Give the rows of the data sheet as dictionaries, keyed by the column
+    headers in the first row. Rows are read lazily, so this also works on
+    the worksheets of a read-only workbook."""
     source_empty = False
     for index, row in enumerate(sheet.values):
         if index == 0:
             keys = [cell for cell in row if cell]
             continue
-        row_dict = {k: row[i] for i, k in enumerate(keys)}
+        # Read-only worksheets may give rows without their trailing empty
+        # cells
+        row_dict = {k: row[i] if i < len(row) else None for i, k in enumerate(keys)}
         if row_dict['source'] is None:
             # do not register rows with empty source field
             # if previous row had empty source field too, stop reading
@@ -376,11 +840,52 @@ def import_dataset(input_file):
             else:
                 source_empty = True
                 continue
-        place = Place.objects.create_place(
-            row_dict, sheet2
-        )
-        Record.objects.create_record(
-            row_dict, place
-        )
+        yield row_dict
+
+
+@contextmanager
+def open_dataset(
+        input_file
+) -> Iterator[Tuple[Dict[Any, Tuple[Optional[float], Optional[float]]], Iterator[Dict[str, Any]]]]:
+    """Open the input file as a read-only workbook and give the index of
+    the sheet with location info together with a generator of the rows of
+    the data sheet. Cells are streamed from the file while the rows are
+    consumed, so memory use does not depend on the size of the sheet."""
+    wb = openpyxl.load_workbook(filename=input_file, read_only=True)
+    try:
+        locations = location_index(wb['ID settlements without Pleiades'].values)
+        yield locations, iter_data_rows(wb['Data JewishMigration'])
+    finally:
+        # Read-only workbooks keep the file open until closed
+        wb.close()
+
+
+# Models with the imported dataset, which are emptied by truncate_dataset.
+# Through tables and the search table are emptied along with them.
+DATASET_MODELS = [
+    Area, Region, Place, Record, PrimaryCategory, SecondaryCategory,
+    Language, Script, Century, Publication
+]
+
+
+def truncate_dataset() -> None:
+    """Remove all data with one TRUNCATE statement, which is much faster
+    than deleting it through the ORM. This takes an exclusive lock on the
+    tables until the end of the transaction, and sends no signals."""
+    tables = ', '.join(model._meta.db_table for model in DATASET_MODELS)
+    with connection.cursor() as cursor:
+        cursor.execute(f'TRUNCATE {tables} CASCADE')
+    invalidate_snapshot_on_commit()
 
-    
+
+def import_dataset(input_file):
+    with open_dataset(input_file) as (locations, rows), \
+            RecordSearch.objects.defer_refresh():
+        choice_cache = ChoiceFieldCache()
+        for row_dict in rows:
+            place = Place.objects.create_place(
+                row_dict, locations
+            )
+            Record.objects.create_record(
+                row_dict, place, choice_cache
+            )
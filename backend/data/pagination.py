@@ -0,0 +1,25 @@
+from rest_framework.pagination import CursorPagination
+
+
+class RecordCursorPagination(CursorPagination):
+    """Keyset pagination of records by source. Fetching a page takes the
+    same time for every page, however many records there are.
+
+    The page size is 100 by default and can be set with the page_size query
+    parameter. Clients that need all records at once can pass
+    paginate=false. Results of a full-text search are paginated by rank.
+    """
+    ordering = ('source', 'pk')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        if 'rank' in queryset.query.annotations:
+            return ('-rank', 'pk')
+        return super().get_ordering(request, queryset, view)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get('paginate') == 'false':
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -1,113 +1,329 @@
+from array import array
+from bisect import bisect_left
+from math import isnan
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Dict, Iterable, Optional, Tuple
+import hashlib
+import json
+import mmap
+import os
+import struct
 import requests
 import gzip
 import ijson
-import pickle
 
 from django.conf import settings
 
 
+CHUNK_SIZE = 64 * 1024
+
+
 class PleiadesError(RuntimeError):
     pass
 
 
+class _HashingReader:
+    '''File-like wrapper that hashes all data that is read from it'''
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+
+class PleiadesIndex:
+    '''Read-only, memory-mapped index of the coordinates of Pleiades places.
+
+    The index file consists of a header, followed by three columns of equal
+    length: the sorted Pleiades ids (64-bit integers), and the longitudes and
+    latitudes of their reprPoint (64-bit floats, NaN if there is none). The
+    file is memory-mapped, so loading is instant, the operating system
+    shares its pages between processes, and ids are looked up with a binary
+    search.'''
+    MAGIC = b'JHMPLIDX'
+    # Magic and number of entries. The file is written in native byte order
+    # and is only meant to be used on the machine that created it.
+    HEADER = struct.Struct('=8sQ')
+
+    def __init__(self, path: Path):
+        try:
+            with open(path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as err:
+            # mmap raises ValueError on empty files
+            raise PleiadesError(
+                'Error while reading Pleiades index: {}'.format(err)
+            )
+        try:
+            magic, count = self.HEADER.unpack_from(self._mmap)
+            if magic != self.MAGIC or len(self._mmap) != \
+                    self.HEADER.size + count * 3 * 8:
+                raise ValueError('invalid index file')
+        except (struct.error, ValueError) as err:
+            self._mmap.close()
+            raise PleiadesError(
+                'Error while reading Pleiades index: {}'.format(err)
+            )
+        view = memoryview(self._mmap)[self.HEADER.size:]
+        self._ids = view[:count * 8].cast('q')
+        self._longitudes = view[count * 8:count * 16].cast('d')
+        self._latitudes = view[count * 16:].cast('d')
+        view.release()
+
+    @classmethod
+    def write(
+            cls, path: Path, points: Dict[int, Optional[Tuple[float, float]]]
+    ) -> None:
+        '''Write an index file for a dictionary from Pleiades id to
+        (longitude, latitude), or None if the place has no reprPoint. The
+        file is replaced atomically, so readers never see a partial file.'''
+        ids = array('q', sorted(points))
+        longitudes = array('d')
+        latitudes = array('d')
+        for pleiades_id in ids:
+            point = points[pleiades_id]
+            longitudes.append(point[0] if point else float('nan'))
+            latitudes.append(point[1] if point else float('nan'))
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(ids)))
+            ids.tofile(f)
+            longitudes.tofile(f)
+            latitudes.tofile(f)
+        os.replace(temp_path, path)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def position(self, pleiades_id: int) -> Optional[int]:
+        '''Give the position of an id in the index, or None if it does not
+        exist.'''
+        position = bisect_left(self._ids, pleiades_id)
+        if position < len(self._ids) and self._ids[position] == pleiades_id:
+            return position
+        return None
+
+    def positions(self, pleiades_ids: Iterable[int]) -> Dict[int, int]:
+        '''Give the positions of many ids in one pass over the index. Ids
+        that do not exist are left out.'''
+        positions = {}
+        position = 0
+        for pleiades_id in sorted(set(pleiades_ids)):
+            # Ids are sorted, so each search continues where the last one
+            # ended
+            position = bisect_left(self._ids, pleiades_id, position)
+            if position == len(self._ids):
+                break
+            if self._ids[position] == pleiades_id:
+                positions[pleiades_id] = position
+        return positions
+
+    def point(self, position: int) -> Optional[Tuple[float, float]]:
+        '''Give (longitude, latitude) of the entry at a position, or None
+        if it has no reprPoint.'''
+        longitude = self._longitudes[position]
+        if isnan(longitude):
+            return None
+        return longitude, self._latitudes[position]
+
+    def close(self) -> None:
+        for view in (self._ids, self._longitudes, self._latitudes):
+            view.release()
+        self._mmap.close()
+
+
 class PleiadesFetcher:
     PLEIADES_URL = 'https://atlantides.org/downloads/pleiades/json/' \
         'pleiades-places-latest.json.gz'
-    _pleiades_data: Optional[dict] = None
+    _index: Optional[PleiadesIndex] = None
     pleiades_path: Path
 
     def __init__(self):
         try:
             self.pleiades_path = Path(settings.EXTERNAL_DATA_DIRECTORY) / \
                 'pleiades.json'
-            self.pleiades_pickle_path = \
-                Path(settings.EXTERNAL_DATA_DIRECTORY) / 'pleiades.pickle'
+            self.pleiades_index_path = \
+                Path(settings.EXTERNAL_DATA_DIRECTORY) / 'pleiades.index'
+            self.pleiades_metadata_path = \
+                Path(settings.EXTERNAL_DATA_DIRECTORY) / 'pleiades.index.json'
         except AttributeError:
             raise PleiadesError(
                 'EXTERNAL_DATA_DIRECTORY setting must be set in settings.py'
             )
 
-    def download_dump(self) -> None:
-        '''Download the latest version of the Pleiades dump and put it in
-        the EXTERNAL_DATA_DIRECTORY directory of settings.py'''
+    def _read_points(
+            self, f: BinaryIO
+    ) -> Dict[int, Optional[Tuple[float, float]]]:
+        '''Read the reprPoint of all places from a binary stream of the
+        Pleiades JSON dump'''
+        points: Dict[int, Optional[Tuple[float, float]]] = {}
+        places = ijson.items(f, '@graph.item')
+        for place in places:
+            # Only retrieve the data we need, because otherwise
+            # we would need a lot of memory
+            reprpoint = place['reprPoint']
+            points[int(place['id'])] = (
+                float(reprpoint[0]), float(reprpoint[1])
+            ) if reprpoint else None
+        return points
+
+    def read_metadata(self) -> dict:
+        '''Give the freshness metadata of the index: the ETag and
+        Last-Modified headers and the SHA-256 hash of the dump it was built
+        from. Give an empty dictionary if they are not known.'''
+        try:
+            with open(self.pleiades_metadata_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_metadata(self, metadata: dict) -> None:
+        temp_path = self.pleiades_metadata_path.with_name(
+            self.pleiades_metadata_path.name + '.tmp'
+        )
+        with open(temp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(temp_path, self.pleiades_metadata_path)
+
+    def refresh(self, force: bool = False) -> bool:
+        '''Download the latest version of the Pleiades dump and convert it
+        to an index file in the EXTERNAL_DATA_DIRECTORY directory of
+        settings.py, but only if it changed since the index was built.
+        Return whether the index changed.
+
+        The request is conditional on the stored ETag and Last-Modified
+        headers, and the index is only rebuilt if the hash of the dump
+        differs from the stored one. Pass force to always rebuild. The dump
+        is streamed: it is decompressed and parsed while it is downloaded,
+        and neither the compressed nor the uncompressed dump is kept in
+        memory or on disk.'''
         try:
-            self.pleiades_path.parent.mkdir(exist_ok=True, parents=True)
+            self.pleiades_index_path.parent.mkdir(exist_ok=True, parents=True)
         except OSError as err:
             raise PleiadesError(
                 'Could not create external data directory: {}'.format(err)
             )
+        metadata = self.read_metadata()
+        if force or not self.pleiades_index_path.exists():
+            metadata = {}
+        headers = {}
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last_modified'):
+            headers['If-Modified-Since'] = metadata['last_modified']
         print(
-            'Downloading latest Pleiades data from {}...'
+            'Downloading and converting latest Pleiades data from {}...'
             .format(self.PLEIADES_URL)
         )
         try:
-            request = requests.get(self.PLEIADES_URL, allow_redirects=True)
+            with requests.get(
+                    self.PLEIADES_URL, allow_redirects=True, stream=True,
+                    headers=headers
+            ) as response:
+                if response.status_code == 304:
+                    print('Pleiades data has not changed.')
+                    return False
+                response.raise_for_status()
+                # Undo any transfer encoding; the dump itself is gzipped
+                response.raw.decode_content = True
+                dump = _HashingReader(response.raw)
+                with gzip.GzipFile(fileobj=dump) as f:
+                    points = self._read_points(f)
+                    # Read any trailing data, so that it is hashed as well
+                    while f.read(CHUNK_SIZE):
+                        pass
+                new_metadata = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'sha256': dump.hash.hexdigest(),
+                }
         except requests.RequestException as err:
             raise PleiadesError(
                 'Error while downloading Pleiades file: {}'.format(err)
             )
+        except (OSError, EOFError, ijson.JSONError) as err:
+            # OSError also catches gzip.BadGzipFile; EOFError is raised on
+            # truncated downloads
+            raise PleiadesError(
+                'Error while converting Pleiades file: {}'.format(err)
+            )
+        changed = new_metadata['sha256'] != metadata.get('sha256')
         try:
-            with open(self.pleiades_path, 'wb') as f:
-                f.write(gzip.decompress(request.content))
+            if changed:
+                PleiadesIndex.write(self.pleiades_index_path, points)
+            self._write_metadata(new_metadata)
         except OSError as err:
-            # This also catches gzip.BadGzipFile
             raise PleiadesError(
-                'Error while decompressing Pleiades file: {}'.format(err)
+                'Error while writing Pleiades index: {}'.format(err)
             )
+        if changed:
+            # Load the new index on the next fetch
+            self.reset()
+        else:
+            print('Pleiades data has not changed.')
+        return changed
 
-    def pickle_data(self) -> None:
-        '''Read Pleiades data into memory to allow efficient access. Download
-        data if necessary. Save as Pickle file.'''
+    def download_index(self) -> None:
+        '''Download the latest version of the Pleiades dump and convert it
+        to an index file, whether or not it changed.'''
+        self.refresh(force=True)
+
+    def build_index(self) -> None:
+        '''Convert Pleiades data to an index file to allow efficient access.
+        If an uncompressed dump exists in the external data directory, it is
+        used; otherwise the latest dump is downloaded.'''
         if not self.pleiades_path.exists():
-            # Download if the file does not yet exist. In the future, perhaps
-            # check if the data may need an update (the JSON file is updated
-            # daily).
-            self.download_dump()
+            self.download_index()
+            return
         print('Converting all Pleiades data...')
         try:
             with open(self.pleiades_path, 'rb') as f:  # IJSON needs bin data
-                self._pleiades_data = {}
-                places = ijson.items(f, '@graph.item')
-                for place in places:
-                    pl_id = int(place['id'])
-                    # Only retrieve the data we need, because otherwise
-                    # we would need a lot of memory
-                    self._pleiades_data[pl_id] = {
-                        'reprPoint': place['reprPoint']
-                    }
-            with open(self.pleiades_pickle_path, 'wb') as f:
-                pickle.dump(self._pleiades_data, f)
-        except (OSError, ijson.JSONERROR) as err:
+                points = self._read_points(f)
+            PleiadesIndex.write(self.pleiades_index_path, points)
+        except (OSError, ijson.JSONError) as err:
             raise PleiadesError(
                 'Error while converting Pleiades file: {}'.format(err)
             )
 
     def get_data(self) -> None:
-        '''Read Pleiades pickle file into memory; create it if it does not yet
+        '''Memory-map the Pleiades index file; create it if it does not yet
         exist'''
-        if self.pleiades_pickle_path.exists():
-            with open(self.pleiades_pickle_path, 'rb') as f:
-                self._pleiades_data = pickle.load(f)
-        else:
-            self.pickle_data()
+        if not self.pleiades_index_path.exists():
+            self.build_index()
+        self._index = PleiadesIndex(self.pleiades_index_path)
 
     def reset(self) -> None:
         '''Reset this object so that memory is freed from all Pleiades data'''
-        self._pleiades_data = None
+        if self._index is not None:
+            self._index.close()
+        self._index = None
 
     def fetch(self, pleiades_id: int) -> Optional[dict]:
         '''Fetch Pleiades data from one id. Download latest Pleiades JSON
         dump first if necessary. Return None if not found.'''
-        if self._pleiades_data is None:
+        if self._index is None:
             self.get_data()
-        assert self._pleiades_data is not None
-        try:
-            data = self._pleiades_data[pleiades_id]
-        except KeyError:
+        assert self._index is not None
+        position = self._index.position(pleiades_id)
+        if position is None:
             return None
-        return data
+        point = self._index.point(position)
+        return {'reprPoint': list(point) if point else None}
+
+    def fetch_many(self, pleiades_ids: Iterable[int]) -> Dict[int, dict]:
+        '''Fetch Pleiades data from many ids in one pass over the index.
+        Ids that are not found are left out of the result.'''
+        if self._index is None:
+            self.get_data()
+        assert self._index is not None
+        result = {}
+        for pleiades_id, position in self._index.positions(pleiades_ids).items():
+            point = self._index.point(position)
+            result[pleiades_id] = {'reprPoint': list(point) if point else None}
+        return result
 
 
 pleiades_fetcher = PleiadesFetcher()
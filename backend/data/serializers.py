@@ -1,6 +1,9 @@
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db.models import OuterRef, QuerySet
 from rest_framework import serializers
 
-from .models import Language, Record
+from .metrics import serializer_timer
+from .models import Century, Language, Place, Record, Script
 
 class PointField(serializers.CharField):
     def to_representation(self, value):
@@ -15,7 +18,15 @@ class ChoiceField(serializers.BaseSerializer):
         return instance.name
 
 
-class RecordSerializer(serializers.ModelSerializer):
+class TimedSerializerMixin:
+    """Counts the time spent in the serializer as serializer time of the
+    request (see metrics.py)."""
+    def to_representation(self, instance):
+        with serializer_timer():
+            return super().to_representation(instance)
+
+
+class RecordSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     place_name = serializers.CharField(source='place.name', allow_null=True)
     area = serializers.CharField(source='place.area.name', allow_null=True)
     region = serializers.CharField(source='place.region.name', allow_null=True)
@@ -25,7 +36,7 @@ class RecordSerializer(serializers.ModelSerializer):
     languages = ChoiceField(many=True)
     scripts = ChoiceField(many=True)
     estimated_centuries = ChoiceField(many=True)
-    publication = serializers.CharField(source='publication.name', allow_null=True)
+    publication = serializers.CharField(source='publication.identifier', allow_null=True)
 
     class Meta:
         model = Record
@@ -38,4 +49,75 @@ class RecordSerializer(serializers.ModelSerializer):
             'sex_deceased', 'symbol', 'comments', 'inscription', 'transcription',
             'publication'
         ]
-    
+
+
+class PlaceSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    area = serializers.CharField(source='area.name', allow_null=True)
+    region = serializers.CharField(source='region.name', allow_null=True)
+    coordinates = PointField(allow_null=True)
+
+    class Meta:
+        model = Place
+        fields = ['id', 'name', 'area', 'region', 'pleiades_id', 'coordinates']
+
+
+class FastRecordSerializer:
+    """Serializes records to the same output as RecordSerializer, but from
+    rows of a values() queryset instead of model instances, bypassing the
+    field machinery of DRF. The names of languages, scripts and estimated
+    centuries are aggregated into arrays in the same query.
+
+    Use annotate() to turn a queryset of records into a queryset of rows,
+    and to_representation() to serialize a row.
+    """
+    # Lookups for the values() queryset, by field of RecordSerializer
+    lookups = {
+        'source': 'source',
+        'languages': 'language_names',
+        'scripts': 'script_names',
+        'place_name': 'place__name',
+        'area': 'place__area__name',
+        'region': 'place__region__name',
+        'coordinates': 'place__coordinates',
+        'category1': 'category1__name',
+        'category2': 'category2__name',
+        'period': 'period',
+        'estimated_centuries': 'century_names',
+        'mentioned_placenames': 'mentioned_placenames',
+        'inscriptions_count': 'inscriptions_count',
+        'religious_profession': 'religious_profession',
+        'sex_dedicator': 'sex_dedicator',
+        'sex_deceased': 'sex_deceased',
+        'symbol': 'symbol',
+        'comments': 'comments',
+        'inscription': 'inscription',
+        'transcription': 'transcription',
+        'publication': 'publication__identifier',
+    }
+    fields = RecordSerializer.Meta.fields
+
+    @classmethod
+    def annotate(cls, queryset: QuerySet) -> QuerySet:
+        # Order the names like the default ordering of each model
+        names = {
+            'language_names': Language.objects.order_by('name'),
+            'script_names': Script.objects.order_by('name'),
+            'century_names': Century.objects.order_by('century_number'),
+        }
+        return queryset.prefetch_related(None).annotate(**{
+            name: ArraySubquery(
+                choices.filter(record=OuterRef('pk')).values('name')
+            ) for name, choices in names.items()
+        }).values(*cls.lookups.values(), *(
+            # Needed for the page cursor of ranked search results
+            ['rank'] if 'rank' in queryset.query.annotations else []
+        ))
+
+    @classmethod
+    def to_representation(cls, row: dict) -> dict:
+        data = {field: row[cls.lookups[field]] for field in cls.fields}
+        if data['coordinates'] is not None:
+            data['coordinates'] = PointField().to_representation(
+                data['coordinates']
+            )
+        return data
@@ -0,0 +1,120 @@
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete
+)
+from django.dispatch import receiver
+
+from .models import (
+    Area, Region, Place, Record, RecordSearch, PrimaryCategory,
+    SecondaryCategory, Language, Script, Century, Publication
+)
+from .snapshot import invalidate_snapshot_on_commit
+
+# Models whose changes show up in the API
+SNAPSHOT_MODELS = [
+    Area, Region, Place, Record, PrimaryCategory, SecondaryCategory,
+    Language, Script, Century, Publication
+]
+
+
+def data_changed(sender, **kwargs):
+    invalidate_snapshot_on_commit()
+
+
+for model in SNAPSHOT_MODELS:
+    post_save.connect(data_changed, sender=model, dispatch_uid=f'snapshot-save-{model.__name__}')
+    post_delete.connect(data_changed, sender=model, dispatch_uid=f'snapshot-delete-{model.__name__}')
+
+
+@receiver(m2m_changed, sender=Record.languages.through)
+@receiver(m2m_changed, sender=Record.scripts.through)
+@receiver(m2m_changed, sender=Record.estimated_centuries.through)
+def relations_changed(sender, action, instance, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # The records of a reverse relation are no longer known after it
+        # is cleared
+        if reverse and not RecordSearch.objects.refresh_deferred():
+            instance._cleared_record_ids = choice_record_ids(instance)
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    invalidate_snapshot_on_commit()
+    if RecordSearch.objects.refresh_deferred():
+        return
+    # The relations are copied to the search table
+    if not reverse:
+        RecordSearch.objects.refresh([instance.pk])
+    elif pk_set is not None:
+        RecordSearch.objects.refresh(pk_set)
+    else:
+        RecordSearch.objects.refresh(
+            getattr(instance, '_cleared_record_ids', [])
+        )
+
+
+@receiver(post_save, sender=Record)
+def record_saved(sender, instance, **kwargs):
+    if not RecordSearch.objects.refresh_deferred():
+        RecordSearch.objects.refresh([instance.pk])
+
+
+@receiver(post_save, sender=Place)
+def place_saved(sender, instance, created, **kwargs):
+    # The coordinates of the place are copied to the search table
+    if not created and instance.coordinates_changed() \
+            and not RecordSearch.objects.refresh_deferred():
+        RecordSearch.objects.refresh(instance.records.all())
+
+
+@receiver(pre_delete, sender=Place)
+def place_deleting(sender, instance, **kwargs):
+    # The records lose their place when it is deleted, without signals
+    if not RecordSearch.objects.refresh_deferred():
+        instance._record_ids = list(
+            instance.records.values_list('pk', flat=True)
+        )
+
+
+@receiver(post_delete, sender=Place)
+def place_deleted(sender, instance, **kwargs):
+    RecordSearch.objects.refresh(getattr(instance, '_record_ids', []))
+
+
+# Choice models whose names are copied to the search table, and the
+# many-to-many field of records that refers to them
+SEARCH_CHOICE_FIELDS = {
+    Language: 'languages',
+    Script: 'scripts',
+    Century: 'estimated_centuries',
+}
+
+
+def choice_record_ids(instance):
+    field = SEARCH_CHOICE_FIELDS[type(instance)]
+    return list(Record.objects.filter(**{field: instance}).values_list(
+        'pk', flat=True
+    ))
+
+
+def choice_saved(sender, instance, created, **kwargs):
+    # The name (or century number) may have changed
+    if not created and not RecordSearch.objects.refresh_deferred():
+        field = SEARCH_CHOICE_FIELDS[type(instance)]
+        RecordSearch.objects.refresh(
+            Record.objects.filter(**{field: instance})
+        )
+
+
+def choice_deleting(sender, instance, **kwargs):
+    # The relations are deleted with the choice, without signals
+    if not RecordSearch.objects.refresh_deferred():
+        instance._record_ids = choice_record_ids(instance)
+
+
+def choice_deleted(sender, instance, **kwargs):
+    RecordSearch.objects.refresh(getattr(instance, '_record_ids', []))
+
+
+for model in SEARCH_CHOICE_FIELDS:
+    post_save.connect(choice_saved, sender=model, dispatch_uid=f'search-save-{model.__name__}')
+    pre_delete.connect(choice_deleting, sender=model, dispatch_uid=f'search-deleting-{model.__name__}')
+    post_delete.connect(choice_deleted, sender=model, dispatch_uid=f'search-delete-{model.__name__}')
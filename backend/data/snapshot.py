@@ -0,0 +1,114 @@
+"""Precomputed snapshot of the full records list of the API.
+
+The dataset only changes on import or when it is edited in the admin, so
+the complete list of records is rendered to gzipped JSON once and kept in
+the 'snapshots' cache under a version key. Any change to the data gives a
+new version (see signals.py); the snapshot of the new version is rendered
+on the first request that needs it.
+"""
+from typing import Any, Callable, NamedTuple, Optional
+from uuid import uuid4
+import gzip
+import hashlib
+
+from django.core.cache import caches
+from django.db import transaction
+
+CACHE_ALIAS = 'snapshots'
+VERSION_KEY = 'records-snapshot-version'
+# Snapshots of old versions are never requested again; let them expire
+SNAPSHOT_TIMEOUT = 24 * 60 * 60
+
+
+class Snapshot(NamedTuple):
+    version: str
+    etag: str
+    gzipped: bytes
+
+    def content(self) -> bytes:
+        return gzip.decompress(self.gzipped)
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def current_version() -> str:
+    """Give the version of the dataset, creating one if there is none."""
+    version = _cache().get(VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        # Another process may have created a version in the meantime
+        if not _cache().add(VERSION_KEY, version, None):
+            version = _cache().get(VERSION_KEY)
+    return version
+
+
+def invalidate_snapshot() -> None:
+    """Mark the dataset as changed, so that the snapshot is rendered again.
+    Changes that bypass model signals, such as bulk_create, bulk_update and
+    update, need to be followed by invalidate_snapshot_on_commit."""
+    _cache().set(VERSION_KEY, uuid4().hex, None)
+
+
+def invalidate_snapshot_on_commit() -> None:
+    """Invalidate the snapshot once the current transaction is committed,
+    or right away outside a transaction. Until then, other requests can
+    only see the old data, so it must not be rendered under a new version.
+    Many changes in one transaction invalidate the snapshot only once."""
+    connection = transaction.get_connection()
+    if any(callback[1] is invalidate_snapshot
+           for callback in connection.run_on_commit):
+        return
+    transaction.on_commit(invalidate_snapshot)
+
+
+def render_snapshot(version: str) -> Snapshot:
+    # Imported here, because the models use invalidate_snapshot
+    from rest_framework.renderers import JSONRenderer
+    from .models import Record
+    from .serializers import FastRecordSerializer
+
+    content = JSONRenderer().render([
+        FastRecordSerializer.to_representation(row)
+        for row in FastRecordSerializer.annotate(
+            Record.objects.order_by('source')
+        )
+    ])
+    return Snapshot(
+        version=version,
+        etag='"{}"'.format(hashlib.sha256(content).hexdigest()),
+        gzipped=gzip.compress(content),
+    )
+
+
+def get_snapshot() -> Snapshot:
+    """Give the snapshot of the current version of the dataset, rendering
+    it if necessary."""
+    version = current_version()
+    key = 'records-snapshot:{}'.format(version)
+    snapshot: Optional[Snapshot] = _cache().get(key)
+    if snapshot is None:
+        snapshot = render_snapshot(version)
+        _cache().set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def cached_for_version(name: str, compute: Callable[[], Any]) -> Any:
+    """Give a value that is derived from the dataset, such as an aggregate,
+    from the cache. It is computed again when the dataset changes."""
+    key = 'records-derived:{}:{}'.format(
+        current_version(), hashlib.sha256(name.encode()).hexdigest()
+    )
+    value = _cache().get(key)
+    if value is None:
+        value = compute()
+        _cache().set(key, value, SNAPSHOT_TIMEOUT)
+    return value
+
+
+def rebuild_snapshot() -> Snapshot:
+    """Start a new version and render its snapshot right away, so that no
+    request has to wait for it."""
+    invalidate_snapshot()
+    return get_snapshot()
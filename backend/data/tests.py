@@ -1,19 +1,68 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 from os.path import join
+import datetime
+import gzip
 import json
+import threading
 import tempfile
 import shutil
+from unittest import mock
 import pytest
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .pleiades import PleiadesFetcher
-from .models import Century, import_dataset, Record
-from .utils import to_decimal
+from .benchmarks import (
+    LiveDatabaseError, fast_render_records, render_records, run_benchmarks,
+    synthetic_pleiades, write_synthetic_pleiades, write_synthetic_workbook,
+)
+from .bulk_import import (
+    BulkImporter, DatasetValidationError, bulk_import_dataset,
+    incremental_import_dataset, replace_dataset,
+)
+from .jobs import run_queued_jobs
+from .metrics import Metrics, metrics
+from .pleiades import PleiadesFetcher, PleiadesIndex, pleiades_fetcher
+from .models import (
+    Area, Century, ChoiceFieldCache, import_dataset, ImportJob, Language,
+    open_dataset, Place, PleiadesUpdateResult, Publication, Record,
+    RecordSearch, Region, Script, truncate_dataset,
+)
+from .serializers import RecordSerializer
+from .tiles import render_tile
+from .utils import content_hash, location_index, to_decimal
+from .views import RecordViewSet
 
 TESTDATA_LOCATION = join(Path(__file__).parent, 'testdata')
 
-class PleiadesTest(TestCase):
+# Every cache in memory, so that tests never touch the caches on disk
+TEST_CACHES = {
+    alias: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': f'test-{alias}',
+    }
+    for alias in ['default', 'snapshots', 'progress']
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DataTestCase(TestCase):
+    """Test case with the caches in memory, emptied before each test."""
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+
+class PleiadesTest(DataTestCase):
     TESTDATA_FILE =  join(TESTDATA_LOCATION, 'pleiades.json')
 
     def test_fetch(self):
@@ -35,14 +84,328 @@ class PleiadesTest(TestCase):
             # Test if nonexisting ID raises error
             place = fetcher.fetch(5)
             assert place is None
+            fetcher.reset()
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            with self.settings(EXTERNAL_DATA_DIRECTORY=datadir):
+                fetcher = PleiadesFetcher()
+                shutil.copy(self.TESTDATA_FILE, datadir)
+                fetcher.build_index()
+                # Once the index exists, the JSON dump is no longer needed
+                fetcher.pleiades_path.unlink()
+                place = fetcher.fetch(48210385)
+                assert place == {'reprPoint': [13.4119837, 42.082885]}
+                fetcher.reset()
+
+    def test_index_without_reprpoint(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            path = Path(datadir) / 'pleiades.index'
+            PleiadesIndex.write(path, {3: (1.5, 2.5), 1: None})
+            index = PleiadesIndex(path)
+            assert len(index) == 2
+            assert index.point(index.position(1)) is None
+            assert index.point(index.position(3)) == (1.5, 2.5)
+            assert index.position(2) is None
+            assert index.positions([3, 2, 1, 3, 5]) == {1: 0, 3: 1}
+            index.close()
+
+
+class PleiadesDownloadTest(DataTestCase):
+    """Test downloading the Pleiades dump from a local HTTP server."""
+
+    def setUp(self):
+        super().setUp()
+        with open(PleiadesTest.TESTDATA_FILE, 'rb') as f:
+            self.dump = gzip.compress(f.read())
+        self.etag = '"1"'
+        self.request_count = 0
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.request_count += 1
+                if test.etag and self.headers.get('If-None-Match') == test.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/gzip')
+                self.send_header('Content-Length', str(len(test.dump)))
+                if test.etag:
+                    self.send_header('ETag', test.etag)
+                self.end_headers()
+                self.wfile.write(test.dump)
 
+            def log_message(self, *args):
+                pass
 
-class RecordTest(TestCase):
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/pleiades-places-latest.json.gz' \
+            .format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_index(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            with self.settings(EXTERNAL_DATA_DIRECTORY=datadir):
+                fetcher = PleiadesFetcher()
+                fetcher.PLEIADES_URL = self.url
+                place = fetcher.fetch(48210386)
+                assert place == {'reprPoint': [11.6285463, 42.4193742]}
+                # The uncompressed dump is never written to disk
+                assert not fetcher.pleiades_path.exists()
+                assert fetcher.pleiades_index_path.exists()
+                fetcher.reset()
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            with self.settings(EXTERNAL_DATA_DIRECTORY=datadir):
+                fetcher = PleiadesFetcher()
+                fetcher.PLEIADES_URL = self.url
+                assert fetcher.refresh()
+                assert fetcher.read_metadata()['etag'] == self.etag
+                # Not modified according to the ETag
+                assert not fetcher.refresh()
+                # No ETag, but the same content
+                self.etag = None
+                assert not fetcher.refresh()
+                # Changed content
+                data = json.loads(gzip.decompress(self.dump))
+                data['@graph'][0]['reprPoint'] = [1.0, 2.0]
+                self.dump = gzip.compress(json.dumps(data).encode())
+                assert fetcher.refresh()
+                assert fetcher.fetch(int(data['@graph'][0]['id'])) == \
+                    {'reprPoint': [1.0, 2.0]}
+                assert self.request_count == 4
+                fetcher.reset()
+
+
+class PlaceFromPleiadesTest(DataTestCase):
+    def test_update_from_pleiades(self):
+        unchanged = Place.objects.create(
+            name='Unchanged', pleiades_id=1, coordinates=Point(1.0, 2.0)
+        )
+        changed = Place.objects.create(
+            name='Changed', pleiades_id=2, coordinates=Point(1.0, 2.0)
+        )
+        missing = Place.objects.create(
+            name='Missing', pleiades_id=3, coordinates=Point(1.0, 2.0)
+        )
+        no_coordinates = Place.objects.create(name='No coordinates', pleiades_id=4)
+        Place.objects.create(name='No Pleiades id')
+        record = Record.objects.create(source='a', place=changed)
+        pleiades = {
+            1: {'reprPoint': [1.0, 2.0]}, 2: {'reprPoint': [3.0, 4.0]},
+            4: {'reprPoint': None},
+        }
+        fetch_many = lambda ids: {i: pleiades[i] for i in ids if i in pleiades}
+        with mock.patch.object(pleiades_fetcher, 'fetch_many', fetch_many):
+            # Select places, update the changed ones, and delete and insert
+            # the search rows of their records, whose ids are selected in
+            # a subquery
+            with self.assertNumQueries(4):
+                result = Place.objects.update_from_pleiades()
+        assert result == PleiadesUpdateResult(
+            changed=1, unchanged=1, missing=1, no_coordinates=1,
+            no_pleiades_id=1
+        )
+        unchanged.refresh_from_db()
+        changed.refresh_from_db()
+        missing.refresh_from_db()
+        no_coordinates.refresh_from_db()
+        assert unchanged.coordinates.coords == (1.0, 2.0)
+        assert changed.coordinates.coords == (3.0, 4.0)
+        assert missing.coordinates.coords == (1.0, 2.0)
+        assert no_coordinates.coordinates is None
+        search = RecordSearch.objects.get(record=record)
+        assert search.coordinates.coords == (3.0, 4.0)
+
+
+class RecordTest(DataTestCase):
     TESTDATA_FILE = join(TESTDATA_LOCATION, 'SampleData.xlsx')
 
     def test_data_import(self):
+        refresh = RecordSearch.objects.refresh
+        with mock.patch.object(RecordSearch.objects, 'refresh', wraps=refresh) as mocked:
+            import_dataset(self.TESTDATA_FILE)
+        # Saves do not refresh the search table row by row; it is refreshed
+        # once at the end
+        mocked.assert_called_once_with()
+        assert Record.objects.count() == 7
+        assert RecordSearch.objects.count() == 7
+
+    def test_bulk_data_import(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        assert Record.objects.count() == 7
+        # Importing again updates instead of duplicating
+        bulk_import_dataset(self.TESTDATA_FILE)
+        assert Record.objects.count() == 7
+
+    def test_bulk_import_matches_import(self):
+        def serialize():
+            records = Record.objects.order_by('source')
+            return RecordSerializer(records, many=True).data
+
         import_dataset(self.TESTDATA_FILE)
+        expected = serialize()
+        place_count = Place.objects.count()
+        Record.objects.all().delete()
+        Place.objects.all().delete()
+        bulk_import_dataset(self.TESTDATA_FILE)
+        assert serialize() == expected
+        assert Place.objects.count() == place_count
+
+    def test_bulk_import_query_count(self):
+        # The number of queries should not depend on the number of rows
+        with CaptureQueriesContext(connection) as queries:
+            bulk_import_dataset(self.TESTDATA_FILE)
+        assert len(queries) < 40
+
+    def test_bulk_import_chunks(self):
+        with open_dataset(self.TESTDATA_FILE) as (locations, rows):
+            importer = BulkImporter(locations, chunk_size=2)
+            assert importer.import_rows(rows) == 7
         assert Record.objects.count() == 7
+        assert Record.objects.filter(languages__name='Latin').count() == 7
+
+    def test_incremental_import(self):
+        diff = incremental_import_dataset(self.TESTDATA_FILE)
+        assert len(diff.new) == 7
+        assert Record.objects.count() == 7
+        assert RecordSearch.objects.count() == 7
+        # Nothing changed; only the stored hashes of records and places
+        # are read
+        with CaptureQueriesContext(connection) as queries:
+            diff = incremental_import_dataset(self.TESTDATA_FILE)
+        assert len(diff.unchanged) == 7
+        assert len(queries) == 2
+
+    def test_incremental_import_changes(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        changed, removed = Record.objects.order_by('source')[:2]
+        Record.objects.filter(pk=changed.pk).update(
+            content_hash='outdated', comments='outdated'
+        )
+        removed.delete()
+        Record.objects.create(source='obsolete')
+
+        diff = incremental_import_dataset(self.TESTDATA_FILE, dry_run=True)
+        assert diff.changed == [changed.source]
+        assert diff.new == [removed.source]
+        assert diff.deleted == ['obsolete']
+        assert len(diff.unchanged) == 4
+        assert Record.objects.filter(source='obsolete').exists()
+
+        incremental_import_dataset(self.TESTDATA_FILE)
+        assert Record.objects.count() == 7
+        assert not Record.objects.filter(source='obsolete').exists()
+        assert Record.objects.get(pk=changed.pk).comments != 'outdated'
+        diff = incremental_import_dataset(self.TESTDATA_FILE, dry_run=True)
+        assert len(diff.unchanged) == 7
+
+    def test_incremental_import_places(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        place = Place.objects.order_by('name')[0]
+        coordinates = place.coordinates
+        Place.objects.filter(pk=place.pk).update(
+            content_hash='outdated', coordinates=Point(0, 0)
+        )
+        # A changed record that points to another place
+        moved = Record.objects.exclude(place=place).order_by('source')[0]
+        Record.objects.filter(pk=moved.pk).update(
+            content_hash='outdated', place=Place.objects.create(name='Nowhere')
+        )
+
+        diff = incremental_import_dataset(self.TESTDATA_FILE, dry_run=True)
+        assert diff.changed_places == [place.name]
+        assert diff.changed == [moved.source]
+        incremental_import_dataset(self.TESTDATA_FILE)
+        assert Place.objects.get(pk=place.pk).coordinates == coordinates
+        search = RecordSearch.objects.filter(record__place=place).first()
+        assert search.coordinates == coordinates
+        # The place that was left without records is deleted
+        assert not Place.objects.filter(name='Nowhere').exists()
+        diff = incremental_import_dataset(self.TESTDATA_FILE, dry_run=True)
+        assert diff.changed_places == []
+
+    def test_import_command_options(self):
+        for options in [['--bulk', '--replace'], ['--dry-run'], ['--bulk', '--dry-run']]:
+            with pytest.raises(CommandError):
+                call_command('import_dataset', self.TESTDATA_FILE, *options)
+        assert not Record.objects.exists()
+
+    def test_replace_dataset(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        publication = Publication.objects.create(identifier='CIJ')
+        Record.objects.filter(pk=Record.objects.order_by('source')[0].pk) \
+            .update(publication=publication, location_in_publication='1')
+        Record.objects.create(source='obsolete')
+        assert replace_dataset(self.TESTDATA_FILE) == 7
+        assert Record.objects.count() == 7
+        assert RecordSearch.objects.count() == 7
+        # Links to publications are kept
+        record = Record.objects.get(publication=publication)
+        assert record.location_in_publication == '1'
+
+    def test_replace_dataset_invalid(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        Record.objects.create(source='obsolete')
+        with mock.patch.object(RecordSearch.objects, 'refresh'):
+            with pytest.raises(DatasetValidationError):
+                replace_dataset(self.TESTDATA_FILE)
+        # Nothing changed
+        assert Record.objects.filter(source='obsolete').exists()
+        assert Record.objects.count() == 8
+
+    def test_truncate_dataset(self):
+        bulk_import_dataset(self.TESTDATA_FILE)
+        Publication.objects.create(identifier='CIJ')
+        truncate_dataset()
+        for model in [Record, RecordSearch, Place, Language, Publication]:
+            assert not model.objects.exists()
+
+
+class PlaceTest(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.area = Area.objects.create(name='Algeria')
+        place = Place.objects.create(name='Setif', area=self.area)
+        for source in ['a', 'b', 'c']:
+            Record.objects.create(source=source, place=place)
+        self.place = Place.objects.get(pk=place.pk)
+
+    def test_save_unchanged(self):
+        # Only the place itself is updated
+        with self.assertNumQueries(1):
+            self.place.save()
+
+    def test_save_changed_region(self):
+        self.place.region = Region.objects.create(name='Mauretania')
+        with self.assertNumQueries(3):
+            # Update place, fetch area, update records
+            self.place.save()
+        assert set(Record.objects.values_list('area', 'region')) == \
+            {('Algeria', 'Mauretania')}
+
+    def test_save_changed_coordinates(self):
+        self.place.coordinates = Point(5.41, 36.19)
+        with self.assertNumQueries(3):
+            # Update place, delete and insert the search rows of records
+            self.place.save()
+        assert [search.coordinates.coords for search in RecordSearch.objects.all()] == \
+            [(5.41, 36.19)] * 3
+        with self.assertNumQueries(1):
+            self.place.save()
+
+    def test_resync_denormalized(self):
+        Record.objects.update(area='outdated', region='outdated')
+        assert Record.objects.resync_denormalized() == 3
+        assert set(Record.objects.values_list('area', 'region')) == \
+            {('Algeria', None)}
 
 
 class TestDecimalConversion:
@@ -59,6 +422,28 @@ class TestDecimalConversion:
             assert to_decimal(t)
 
 
+class TestLocationIndex:
+    def test_location_index(self):
+        rows = [
+            ('id', 'area', 'Province-region', 'placename', 'latitude-man', 'longitude-man'),
+            ('H1', 'Algeria', 'Africa Proconsularis', 'Henchir Fouara', "35˚ 24'N", "8˚ 7' E"),
+            ('H2', 'Algeria', 'Africa Proconsularis', 'Festis', 'unknown', 'unknown'),
+            ('H1', 'Algeria', 'Africa Proconsularis', 'Duplicate', "1˚ N", "1˚ E"),
+        ]
+        index = location_index(rows)
+        assert index['H1'] == (to_decimal("35˚ 24'N"), to_decimal("8˚ 7' E"))
+        assert index['H2'] == (None, None)
+        assert 'H3' not in index
+
+
+class TestContentHash:
+    def test_content_hash(self):
+        row = {'source': 'a', 'date': datetime.date(2024, 1, 1), 'id': 1}
+        # The order of the columns does not matter
+        assert content_hash(row) == content_hash(dict(reversed(row.items())))
+        assert content_hash(row) != content_hash({**row, 'id': 2})
+
+
 class TestCentury:
     def test_to_number_negative(self):
         assert Century._to_number("-3") == -3
@@ -87,15 +472,517 @@ class TestCentury:
         assert century.century_number is None
 
 
-class TestSerializer(TestCase):
+class ChoiceFieldCacheTest(DataTestCase):
+    def test_get_many(self):
+        Language.objects.create(name='Latin')
+        cache = ChoiceFieldCache()
+        # One query to load existing entries, one to create missing ones
+        with self.assertNumQueries(2):
+            languages = cache.get_many(Language, ['Latin', 'Greek', 'Greek'])
+        assert [language.name for language in languages] == \
+            ['Latin', 'Greek', 'Greek']
+        assert Language.objects.count() == 2
+        # Once warm, the cache does not need the database
+        with self.assertNumQueries(0):
+            Language.objects.create_records('Greek| Latin', '|', cache=cache)
+
+    def test_century_number(self):
+        cache = ChoiceFieldCache()
+        century = cache.get(Century, '-3')
+        assert Century.objects.get(pk=century.pk).century_number == -3
+
+
+class RecordSearchTest(DataTestCase):
     def setUp(self):
+        super().setUp()
+        self.place = Place.objects.create(name='Rome', coordinates=Point(12.48, 41.89))
+        self.record = Record.objects.create(source='Rome 1', place=self.place)
+        self.record.languages.set([
+            Language.objects.create(name='Latin'),
+            Language.objects.create(name='Greek'),
+        ])
+        self.record.estimated_centuries.set([
+            Century.objects.create(name='2'),
+            Century.objects.create(name='-1'),
+        ])
+        Record.objects.create(source='Rome 2')
+
+    def test_refresh(self):
+        RecordSearch.objects.refresh()
+        assert RecordSearch.objects.count() == 2
+        search = RecordSearch.objects.get(record=self.record)
+        assert search.languages == ['Greek', 'Latin']
+        assert search.scripts == []
+        assert search.century_numbers == [-1, 2]
+        assert not search.unknown_century
+        assert search.coordinates.coords == (12.48, 41.89)
+        assert RecordSearch.objects.get(record__source='Rome 2').coordinates is None
+
+    def test_refresh_records(self):
+        RecordSearch.objects.refresh()
+        self.record.languages.clear()
+        self.place.coordinates = Point(10.32, 36.85)
+        self.place.save()
+        RecordSearch.objects.refresh([self.record.pk])
+        search = RecordSearch.objects.get(record=self.record)
+        assert search.languages == []
+        assert search.coordinates.coords == (10.32, 36.85)
+        assert RecordSearch.objects.count() == 2
+
+    def test_signals(self):
+        # Saving records and places keeps the search table up to date
+        search = RecordSearch.objects.get(record=self.record)
+        assert search.languages == ['Greek', 'Latin']
+        assert search.coordinates.coords == (12.48, 41.89)
+        self.record.scripts.add(Script.objects.create(name='Hebrew'))
+        self.place.coordinates = Point(10.32, 36.85)
+        self.place.save()
+        search = RecordSearch.objects.get(record=self.record)
+        assert search.scripts == ['Hebrew']
+        assert search.coordinates.coords == (10.32, 36.85)
+        self.place.delete()
+        assert RecordSearch.objects.get(record=self.record).coordinates is None
+
+    def test_choice_signals(self):
+        language = Language.objects.get(name='Latin')
+        language.name = 'Latina'
+        language.save()
+        century = Century.objects.get(name='2')
+        century.name = '3'
+        century.save()
+        Language.objects.get(name='Greek').delete()
+        search = RecordSearch.objects.get(record=self.record)
+        assert search.languages == ['Latina']
+        assert search.century_numbers == [-1, 3]
+
+    def test_clear_reverse_relation(self):
+        other = Record.objects.create(source='Rome 3')
+        other.languages.add(Language.objects.create(name='Hebrew'))
+        refresh = RecordSearch.objects.refresh
+        with mock.patch.object(RecordSearch.objects, 'refresh', wraps=refresh) as mocked:
+            Language.objects.get(name='Latin').record_set.clear()
+        # Only the records that had the language are refreshed
+        mocked.assert_called_once_with([self.record.pk])
+        assert RecordSearch.objects.get(record=self.record).languages == ['Greek']
+        assert RecordSearch.objects.get(record=other).languages == ['Hebrew']
+
+    def test_century_list_filter(self):
+        self.client.force_login(User.objects.create_superuser(username='admin'))
+        unknown = Record.objects.create(source='Rome 3')
+        unknown.estimated_centuries.add(Century.objects.create(name='unknown'))
+
+        def sources(century):
+            response = self.client.get('/admin/data/record/', {'century': century})
+            assert response.status_code == 200
+            return sorted(r.source for r in response.context['cl'].result_list)
+        assert sources('2') == ['Rome 1']
+        assert sources('unknown') == ['Rome 3']
+        assert sources('none') == ['Rome 2']
+
+    def test_full_text_search(self):
+        self.client.force_login(User.objects.create_user(username='test'))
+        self.record.inscription = 'Hic iacet Iudas'
+        self.record.comments = 'Found near the synagogue'
+        self.record.save()
+        Record.objects.filter(source='Rome 2').update(comments='Iudas?')
+        RecordSearch.objects.refresh()
+
+        def search(text):
+            response = self.client.get('/api/records/', {'q': text})
+            assert response.status_code == 200
+            return [
+                record['source'] for record in json.loads(response.content)['results']
+            ]
+        # Matches in the inscription rank higher than in the comments
+        assert search('iudas') == ['Rome 1', 'Rome 2']
+        assert search('synagogue') == ['Rome 1']
+        assert search('iudas -synagogue') == ['Rome 2']
+        assert search('menorah') == []
+
+
+class TestSerializer(DataTestCase):
+    def setUp(self):
+        super().setUp()
         TESTDATA_FILE = join(TESTDATA_LOCATION, 'SampleData.xlsx')
         import_dataset(TESTDATA_FILE)
+        # The API is only accessible to authenticated users
+        self.client.force_login(User.objects.create_user(username='test'))
 
     def test_choice_field_serializer(self):
         response = self.client.get('/api/records/')
-        serialized = json.loads(response.content)
+        serialized = json.loads(response.content)['results']
         assert type(serialized[0]['languages']) == list
         assert type(serialized[0]['scripts']) == list
         assert type(serialized[0]['estimated_centuries']) == list
         assert type(serialized[0]['languages'][0]) == str
+
+    def test_pagination(self):
+        response = self.client.get('/api/records/?page_size=3')
+        page = json.loads(response.content)
+        sources = [record['source'] for record in page['results']]
+        assert len(sources) == 3
+        while page['next']:
+            page = json.loads(self.client.get(page['next']).content)
+            sources.extend(record['source'] for record in page['results'])
+        assert sources == sorted(Record.objects.values_list('source', flat=True))
+
+    def test_pagination_opt_out(self):
+        response = self.client.get('/api/records/?paginate=false')
+        serialized = json.loads(response.content)
+        assert len(serialized) == Record.objects.count()
+
+    def test_query_count(self):
+        # The list of the API is serialized by FastRecordSerializer; this
+        # checks that the queryset of the viewset is enough for
+        # RecordSerializer as well
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                RecordSerializer(RecordViewSet.queryset.all(), many=True).data
+            return len(queries)
+
+        expected = count_queries()
+        publication = Publication.objects.create(identifier='Le Bohec 1981')
+        for record in Record.objects.all():
+            languages = list(record.languages.all())
+            record.pk = None
+            record.source = record.source + ' (copy)'
+            record.publication = publication
+            record.save()
+            record.languages.set(languages)
+        assert Record.objects.count() == 14
+        assert count_queries() == expected
+
+    def test_stream(self):
+        response = self.client.get('/api/records/stream/')
+        assert response.streaming
+        streamed = json.loads(b''.join(response.streaming_content))
+        expected = json.loads(
+            self.client.get('/api/records/?paginate=false').content
+        )
+        assert streamed == sorted(expected, key=lambda r: r['source'])
+
+    def test_stream_ndjson(self):
+        response = self.client.get('/api/records/stream/?ndjson=true')
+        lines = b''.join(response.streaming_content).splitlines()
+        assert response['Content-Type'] == 'application/x-ndjson'
+        assert len(lines) == Record.objects.count()
+        assert all(json.loads(line)['source'] for line in lines)
+
+    def test_fast_serializer(self):
+        # Add a record with a publication and without place
+        Record.objects.create(
+            source='no place',
+            publication=Publication.objects.create(identifier='unknown')
+        )
+        queryset = Record.objects.order_by('source')
+        assert fast_render_records(queryset) == render_records(queryset)
+
+    def test_snapshot(self):
+        response = self.client.get(
+            '/api/records/?paginate=false', HTTP_ACCEPT_ENCODING='gzip'
+        )
+        assert response['Content-Encoding'] == 'gzip'
+        etag = response['ETag']
+        content = gzip.decompress(response.content)
+        assert content == fast_render_records(Record.objects.order_by('source'))
+
+        # Not modified
+        response = self.client.get(
+            '/api/records/?paginate=false', HTTP_IF_NONE_MATCH=etag
+        )
+        assert response.status_code == 304
+
+        # Changing the data gives a new snapshot
+        record = Record.objects.get(source='Le Bohec 1981 n. 67')
+        record.comments = 'changed'
+        with self.captureOnCommitCallbacks(execute=True):
+            record.save()
+        response = self.client.get(
+            '/api/records/?paginate=false', HTTP_IF_NONE_MATCH=etag
+        )
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+        assert 'changed' in [r['comments'] for r in json.loads(response.content)]
+
+    def get_sources(self, query):
+        response = self.client.get('/api/records/?paginate=false&' + query)
+        assert response.status_code == 200
+        return sorted(record['source'] for record in json.loads(response.content))
+
+    def test_filter(self):
+        assert len(self.get_sources('area=Algeria')) == 7
+        assert self.get_sources('region=Mauretania Caesariensis') == \
+            ['Le Bohec 1981 n. 73']
+        assert self.get_sources('region=Mauretania Caesariensis&region=Nowhere') == \
+            ['Le Bohec 1981 n. 73']
+        assert self.get_sources('languages=Latin&languages=Greek') == \
+            self.get_sources('')
+        assert self.get_sources('scripts=Greek') == []
+        assert self.get_sources('category2=Column') == ['Le Bohec 1981 n. 68']
+        assert self.get_sources('sex_deceased=male-child') == \
+            ['Le Bohec 1981 n. 67']
+
+    def test_filter_centuries(self):
+        assert self.get_sources('century_min=2&century_max=2') == \
+            ['Le Bohec 1981 n. 71']
+        assert len(self.get_sources('century_min=3')) == 6
+        assert self.get_sources('century_max=-1') == []
+        response = self.client.get('/api/records/?century_min=third')
+        assert response.status_code == 400
+
+
+class SpatialFilterTest(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user(username='test'))
+        places = {
+            'Rome': Point(12.48, 41.89),
+            'Ostia': Point(12.29, 41.76),
+            'Carthage': Point(10.32, 36.85),
+            'Unknown': None,
+        }
+        for name, coordinates in places.items():
+            place = Place.objects.create(name=name, coordinates=coordinates)
+            Record.objects.create(source=name, place=place)
+        RecordSearch.objects.refresh()
+
+    def get_names(self, url):
+        response = self.client.get(url)
+        assert response.status_code == 200
+        return sorted(
+            item.get('name') or item.get('place_name')
+            for item in json.loads(response.content)
+        )
+
+    def test_bbox(self):
+        assert self.get_names('/api/places/?bbox=12,41,13,42') == ['Ostia', 'Rome']
+        assert self.get_names('/api/records/?paginate=false&bbox=10,36,11,37') == \
+            ['Carthage']
+
+    def test_near(self):
+        # Ostia is about 22 km from Rome, Carthage about 600 km
+        assert self.get_names('/api/places/?near=12.48,41.89&radius_km=10') == ['Rome']
+        assert self.get_names('/api/places/?near=12.48,41.89&radius_km=30') == \
+            ['Ostia', 'Rome']
+        assert self.get_names(
+            '/api/records/?paginate=false&near=12.48,41.89&radius_km=1000'
+        ) == ['Carthage', 'Ostia', 'Rome']
+
+    def test_invalid(self):
+        assert self.client.get('/api/places/?bbox=1,2,3').status_code == 400
+        assert self.client.get('/api/places/?near=1,2').status_code == 400
+        assert self.client.get('/api/places/?near=1,2&radius_km=0').status_code == 400
+
+    def test_aggregate(self):
+        Record.objects.filter(source='Rome').update(inscriptions_count=3)
+        response = self.client.get('/api/records/aggregate/')
+        assert response.status_code == 200
+        places = {
+            item['place_name']: item for item in json.loads(response.content)
+        }
+        # Places without coordinates are left out
+        assert sorted(places) == ['Carthage', 'Ostia', 'Rome']
+        assert places['Rome']['records'] == 1
+        assert places['Rome']['inscriptions'] == 3
+        assert places['Rome']['categories'] == {'': 1}
+
+    def test_aggregate_zoom(self):
+        def cells(url):
+            response = self.client.get(url)
+            assert response.status_code == 200
+            return sorted(
+                item['records'] for item in json.loads(response.content)
+            )
+        # Rome and Ostia share a cell at low zoom levels only
+        assert cells('/api/records/aggregate/?zoom=3') == [1, 2]
+        assert cells('/api/records/aggregate/?zoom=10') == [1, 1, 1]
+        assert cells('/api/records/aggregate/?zoom=3&bbox=12,41,13,42') == [2]
+        assert self.client.get(
+            '/api/records/aggregate/?zoom=x'
+        ).status_code == 400
+
+
+class TileTest(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user(username='test'))
+        self.tile_directory = tempfile.mkdtemp()
+        settings_override = override_settings(
+            TILE_CACHE_DIRECTORY=self.tile_directory
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.tile_directory)
+        place = Place.objects.create(name='Rome', coordinates=Point(12.48, 41.89))
+        Record.objects.create(source='Rome', place=place)
+
+    def test_render_tile(self):
+        assert render_tile(0, 0, 0)
+        # Rome is in the north-eastern quarter of the world
+        assert render_tile(1, 1, 0)
+        assert render_tile(1, 0, 1) == b''
+
+    def test_tile_view(self):
+        response = self.client.get('/api/tiles/1/1/0.mvt')
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/vnd.mapbox-vector-tile'
+        assert response.content == render_tile(1, 1, 0)
+        assert list(Path(self.tile_directory).glob('*/1/1/0.mvt'))
+        assert self.client.get('/api/tiles/1/2/0.mvt').status_code == 404
+
+    def test_tile_cache_version(self):
+        self.client.get('/api/tiles/0/0/0.mvt')
+        old_versions = list(Path(self.tile_directory).iterdir())
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.create(source='Rome 2', place=Place.objects.get())
+        self.client.get('/api/tiles/0/0/0.mvt')
+        versions = list(Path(self.tile_directory).iterdir())
+        assert len(versions) == 1
+        assert versions != old_versions
+
+
+class TestMetrics:
+    def test_render(self):
+        registry = Metrics()
+        registry.observe('index', 200, {'jhm_request_queries': 3})
+        registry.observe('index', 200, {'jhm_request_queries': 30})
+        rendered = registry.render()
+        assert 'jhm_requests_total{view="index",status="200"} 2' in rendered
+        # Buckets are cumulative
+        assert 'jhm_request_queries_bucket{view="index",le="5.0"} 1' in rendered
+        assert 'jhm_request_queries_bucket{view="index",le="50.0"} 2' in rendered
+        assert 'jhm_request_queries_bucket{view="index",le="+Inf"} 2' in rendered
+        assert 'jhm_request_queries_sum{view="index"} 33.0' in rendered
+
+
+class MetricsTest(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        place = Place.objects.create(name='Rome', coordinates=Point(12.48, 41.89))
+        Record.objects.create(source='Rome', place=place)
+        self.client.force_login(User.objects.create_user(username='test'))
+
+    def test_request_metrics(self):
+        self.client.get('/api/records/')
+        response = self.client.get('/api/records/stream/')
+        content = b''.join(response.streaming_content)
+        view = ('jhm_request_queries', 'RecordViewSet.list')
+        assert metrics.histograms[view].sum > 0
+        assert ('jhm_serializer_duration_seconds', 'RecordViewSet.list') \
+            in metrics.histograms
+        stream_size = ('jhm_response_size_bytes', 'RecordViewSet.stream')
+        assert metrics.histograms[stream_size].sum == len(content)
+
+    def test_metrics_view(self):
+        assert self.client.get('/metrics').status_code == 403
+        self.client.force_login(User.objects.create_superuser(username='admin'))
+        self.client.get('/admin/data/record/')
+        response = self.client.get('/metrics')
+        assert response.status_code == 200
+        assert b'view="admin:data_record_changelist"' in response.content
+
+    def test_slow_request_log(self):
+        with override_settings(SLOW_REQUEST_THRESHOLD=0), \
+                self.assertLogs('data.metrics', 'WARNING') as logs:
+            self.client.get('/api/records/')
+        assert 'Slow request: GET /api/records/' in logs.output[0]
+        assert 'SELECT' in logs.output[0]
+
+
+class ImportJobTest(DataTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, media_root)
+
+    def create_job(self, content, mode=ImportJob.BULK):
+        return ImportJob.objects.create(
+            file=ContentFile(content, name='data.xlsx'), mode=mode
+        )
+
+    def test_run_job(self):
+        with open(join(TESTDATA_LOCATION, 'SampleData.xlsx'), 'rb') as f:
+            job = self.create_job(f.read())
+        assert run_queued_jobs() == 1
+        job.refresh_from_db()
+        assert job.status == ImportJob.DONE
+        assert job.rows_processed == 7
+        assert 'importing rows' in job.stage_timings
+        assert 'rendering snapshot' in job.stage_timings
+        assert job.rows_per_second > 0
+        assert Record.objects.count() == 7
+        # The queue is empty now
+        assert run_queued_jobs() == 0
+
+    def test_failed_job(self):
+        job = self.create_job(b'not a workbook')
+        run_queued_jobs()
+        job.refresh_from_db()
+        assert job.status == ImportJob.FAILED
+        assert job.error
+
+    def test_stale_job(self):
+        job = self.create_job(b'not a workbook')
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.RUNNING,
+            started=timezone.now() - datetime.timedelta(hours=1),
+        )
+        assert run_queued_jobs() == 0
+        job.refresh_from_db()
+        assert job.status == ImportJob.FAILED
+        assert job.error
+
+    def test_one_job_at_a_time(self):
+        running = self.create_job(b'not a workbook')
+        ImportJob.objects.filter(pk=running.pk).update(
+            status=ImportJob.RUNNING, started=timezone.now()
+        )
+        queued = self.create_job(b'not a workbook')
+        # Another worker runs a job
+        assert run_queued_jobs() == 0
+        queued.refresh_from_db()
+        assert queued.status == ImportJob.QUEUED
+        ImportJob.objects.filter(pk=running.pk).update(status=ImportJob.DONE)
+        assert run_queued_jobs() == 1
+        queued.refresh_from_db()
+        assert queued.status == ImportJob.FAILED
+
+    def test_progress_page(self):
+        self.client.force_login(User.objects.create_superuser(username='admin'))
+        job = self.create_job(b'not a workbook')
+        response = self.client.get(f'/admin/data/importjob/{job.pk}/progress/')
+        assert response.status_code == 200
+        assert b'waiting for a worker' in response.content
+
+
+class BenchmarkTest(DataTestCase):
+    def test_synthetic_corpus(self):
+        with tempfile.TemporaryDirectory() as directory:
+            workbook = Path(directory) / 'synthetic.xlsx'
+            dump = Path(directory) / 'pleiades.json'
+            places = write_synthetic_workbook(workbook, 60)
+            write_synthetic_pleiades(dump, places, extra=10)
+            with synthetic_pleiades(dump):
+                assert bulk_import_dataset(workbook) == 60
+        assert 0 < Place.objects.count() <= len(places)
+        # Places without Pleiades id get coordinates from the location sheet
+        assert not Place.objects.filter(
+            pleiades_id__isnull=True, coordinates__isnull=True
+        ).exists()
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(40, repeat=1)
+        assert results['import_bulk']['queries'] > 0
+        assert results['api_records_page']['seconds'] > 0
+        # The synthetic data is rolled back
+        assert not Record.objects.exists()
+
+    def test_run_benchmarks_live_db(self):
+        Record.objects.create(source='real')
+        with pytest.raises(LiveDatabaseError):
+            run_benchmarks(40, repeat=1)
+        assert Record.objects.filter(source='real').exists()
@@ -0,0 +1,105 @@
+"""Mapbox vector tiles of all places with the number of their records.
+
+Tiles are rendered by PostGIS with ST_AsMVT and kept on disk in
+TILE_CACHE_DIRECTORY, in a directory per dataset version (see snapshot.py).
+When the dataset changes, tiles are rendered again for the new version and
+the directories of old versions are removed.
+"""
+from pathlib import Path
+import os
+import logging
+import shutil
+import uuid
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Area, Place, Record, Region
+from .snapshot import current_version
+
+logger = logging.getLogger(__name__)
+
+MAX_ZOOM = 20
+# Name of the layer in the tiles
+LAYER_NAME = 'places'
+
+TILE_QUERY = '''
+WITH bounds AS (
+    SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+), counts AS (
+    SELECT place_id, COUNT(*) AS records,
+        COALESCE(SUM(inscriptions_count), 0) AS inscriptions
+    FROM {record} GROUP BY place_id
+), features AS (
+    SELECT ST_AsMVTGeom(
+            ST_Transform(place.coordinates, 3857), bounds.geom
+        ) AS geom,
+        place.id, place.name, area.name AS area, region.name AS region,
+        counts.records, counts.inscriptions
+    FROM {place} place
+    JOIN counts ON counts.place_id = place.id
+    LEFT JOIN {area} area ON area.id = place.area_id
+    LEFT JOIN {region} region ON region.id = place.region_id
+    CROSS JOIN bounds
+    WHERE place.coordinates && ST_Transform(bounds.geom, 4326)
+)
+SELECT ST_AsMVT(features.*, %(layer)s) FROM features
+'''.format(
+    record=Record._meta.db_table,
+    place=Place._meta.db_table,
+    area=Area._meta.db_table,
+    region=Region._meta.db_table,
+)
+
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def render_tile(z: int, x: int, y: int) -> bytes:
+    """Render one tile in the XYZ scheme. Each place with records is a
+    point feature with its id, name, area, region, number of records and
+    number of inscriptions. Empty tiles give empty bytes."""
+    with connection.cursor() as cursor:
+        cursor.execute(TILE_QUERY, {
+            'z': z, 'x': x, 'y': y, 'layer': LAYER_NAME,
+        })
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile else b''
+
+
+def _cache_directory() -> Path:
+    return Path(settings.TILE_CACHE_DIRECTORY)
+
+
+def _remove_old_versions(version: str) -> None:
+    for directory in _cache_directory().iterdir():
+        if directory.name != version:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def get_tile(z: int, x: int, y: int) -> bytes:
+    """Give a tile of the current dataset version from the cache, rendering
+    it if necessary."""
+    version = current_version()
+    version_directory = _cache_directory() / version
+    path = version_directory / str(z) / str(x) / f'{y}.mvt'
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        pass
+    tile = render_tile(z, x, y)
+    new_version = not version_directory.exists()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write atomically, since other processes may read the same tile
+        temp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+        temp_path.write_bytes(tile)
+        os.replace(temp_path, path)
+        if new_version:
+            _remove_old_versions(version)
+    except OSError as err:
+        # The tile can still be served; another process may have removed
+        # the directory of an old version
+        logger.warning('Could not cache tile %s/%s/%s: %s', z, x, y, err)
+    return tile
@@ -1,3 +1,6 @@
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
+import hashlib
+import json
 import re
 
 pattern = re.compile(r"[˚';]")
@@ -28,3 +31,27 @@ def to_decimal(x: str):
     if direc == 'W' or direc == 'S':
         dec = -dec
     return dec
+
+
+def location_index(
+        rows: Iterable[Sequence[Any]]
+) -> Dict[Any, Tuple[Optional[float], Optional[float]]]:
+    """Give a dictionary from identifier to (latitude, longitude) for the
+    rows of the sheet with location info: identifier in column 0, latitude
+    in column 4, longitude in column 5. Coordinates are parsed once per row.
+    If an identifier occurs more than once, the first row is used. Rows
+    without identifier are skipped.
+    """
+    index: Dict[Any, Tuple[Optional[float], Optional[float]]] = {}
+    for row in rows:
+        if len(row) > 5 and row[0] is not None and row[0] not in index:
+            index[row[0]] = (to_decimal(row[4]), to_decimal(row[5]))
+    return index
+
+
+def content_hash(value: Any) -> str:
+    """Give a stable SHA-256 hash of a value from the input file, such as a
+    row. The value is hashed as JSON with sorted keys; values that JSON
+    does not support, such as dates, are converted to strings."""
+    data = json.dumps(value, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
@@ -1,16 +1,191 @@
+import json
+from typing import Iterable, Iterator
+
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
 from rest_framework import viewsets
 from rest_framework import permissions
-from .models import Record
-from .serializers import RecordSerializer
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.utils.encoders import JSONEncoder
+
+from .aggregation import MAX_ZOOM, aggregate_records
+from .filters import RecordFilter, SpatialFilter
+from .metrics import metrics, serializer_timer
+from .models import Place, Record
+from .pagination import RecordCursorPagination
+from .serializers import FastRecordSerializer, PlaceSerializer, RecordSerializer
+from .snapshot import cached_for_version, get_snapshot
+from .tiles import get_tile, valid_tile
+
+# Number of records that are fetched from the database cursor at once
+STREAM_CHUNK_SIZE = 500
+
+# Query parameters with which the list of records can be served from the
+# snapshot
+SNAPSHOT_PARAMS = {'paginate', 'format'}
+
+
+def json_array_lines(items: Iterable[dict]) -> Iterator[str]:
+    """Encode items as a JSON array, one element at a time."""
+    separator = '['
+    for item in items:
+        yield separator + json.dumps(item, cls=JSONEncoder)
+        separator = ',\n'
+    yield '[]' if separator == '[' else ']'
+
+
+def ndjson_lines(items: Iterable[dict]) -> Iterator[str]:
+    """Encode items as newline-delimited JSON."""
+    for item in items:
+        yield json.dumps(item, cls=JSONEncoder) + '\n'
 
 
 class RecordViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows records to be viewed.
     """
-    queryset = Record.objects.prefetch_related(
+    # Join foreign keys and prefetch many-to-many fields, so that the number
+    # of queries does not depend on the number of records
+    queryset = Record.objects.select_related(
         'place', 'category1', 'category2', 'publication', 'place__area', 'place__region'
+    ).prefetch_related(
+        'languages', 'scripts', 'estimated_centuries'
     )
     serializer_class = RecordSerializer
+    pagination_class = RecordCursorPagination
+    filter_backends = [RecordFilter, SpatialFilter]
+    spatial_field = 'search__coordinates'
     permission_classes = [permissions.IsAuthenticated]
 
+    def snapshot_response(self, request) -> HttpResponse:
+        """Serve the precomputed snapshot of all records, gzipped if the
+        client accepts it, or 304 if the client already has it."""
+        snapshot = get_snapshot()
+        if request.headers.get('If-None-Match') == snapshot.etag:
+            response = HttpResponseNotModified()
+        elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = HttpResponse(
+                snapshot.gzipped, content_type='application/json'
+            )
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(
+                snapshot.content(), content_type='application/json'
+            )
+        response['ETag'] = snapshot.etag
+        patch_vary_headers(response, ['Accept-Encoding', 'Authorization', 'Cookie'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('paginate') == 'false' \
+                and set(request.query_params) <= SNAPSHOT_PARAMS \
+                and request.accepted_renderer.format == 'json':
+            # The unfiltered list of all records is always the same until
+            # the data changes
+            return self.snapshot_response(request)
+        # Lists are serialized from values() rows, which gives the same
+        # output as RecordSerializer in a fraction of the time
+        queryset = FastRecordSerializer.annotate(
+            self.filter_queryset(self.get_queryset())
+        )
+        page = self.paginate_queryset(queryset)
+        rows = list(queryset) if page is None else page
+        with serializer_timer():
+            data = [FastRecordSerializer.to_representation(row) for row in rows]
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+    @action(detail=False)
+    def stream(self, request):
+        """
+        Stream all records as a JSON array, or as newline-delimited JSON
+        with ndjson=true. Records are read from a server-side cursor in
+        chunks and sent as they are serialized, so the response starts
+        immediately and memory use does not depend on the number of records.
+        """
+        queryset = FastRecordSerializer.annotate(
+            self.filter_queryset(self.get_queryset()).order_by('source')
+        )
+        records = (
+            FastRecordSerializer.to_representation(row)
+            for row in queryset.iterator(chunk_size=STREAM_CHUNK_SIZE)
+        )
+        if request.query_params.get('ndjson') == 'true':
+            return StreamingHttpResponse(
+                ndjson_lines(records), content_type='application/x-ndjson'
+            )
+        return StreamingHttpResponse(
+            json_array_lines(records), content_type='application/json'
+        )
+
+    @action(detail=False)
+    def aggregate(self, request):
+        """
+        Give the number of records, the number of inscriptions and the
+        number of records per primary category, for each place, or for each
+        cell of a grid for the map zoom level given by zoom. Records can be
+        filtered like the list of records. Results are cached until the
+        data changes.
+        """
+        zoom = request.query_params.get('zoom')
+        if zoom is not None:
+            try:
+                zoom = int(zoom)
+            except ValueError:
+                zoom = -1
+            if not 0 <= zoom <= MAX_ZOOM:
+                raise ValidationError(
+                    {'zoom': f'Must be an integer from 0 to {MAX_ZOOM}.'}
+                )
+        queryset = self.filter_queryset(self.get_queryset())
+        params = sorted(request.query_params.lists())
+        data = cached_for_version(
+            'aggregate:{}'.format(params),
+            lambda: aggregate_records(queryset, zoom)
+        )
+        return Response(data)
+
+
+class PlaceViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint that allows places to be viewed. Places can be selected
+    with bbox=min_lon,min_lat,max_lon,max_lat or near=lon,lat&radius_km=r.
+    """
+    queryset = Place.objects.select_related('area', 'region')
+    serializer_class = PlaceSerializer
+    filter_backends = [SpatialFilter]
+    spatial_field = 'coordinates'
+    permission_classes = [permissions.IsAuthenticated]
+
+
+class TileView(APIView):
+    """
+    Mapbox vector tile with all places that have records, in the layer
+    'places'. Each place has its id, name, area, region and number of
+    records and inscriptions. Tiles are cached until the data changes.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, z: int, x: int, y: int):
+        if not valid_tile(z, x, y):
+            raise NotFound('Tile does not exist.')
+        return HttpResponse(
+            get_tile(z, x, y), content_type='application/vnd.mapbox-vector-tile'
+        )
+
+
+class MetricsView(APIView):
+    """
+    Performance metrics of the requests handled by this process, in the
+    Prometheus text format. Only accessible to staff users.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
@@ -37,6 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.gis',
+    'django.contrib.postgres',
     'livereload',
     'django.contrib.staticfiles',
     'django_admin_search',
@@ -50,10 +51,12 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    ]
+    ],
 }
 
 MIDDLEWARE = [
+    # First, so that it measures the other middleware as well
+    'data.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -122,6 +125,28 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered snapshots of the dataset for the API. This cache must be
+    # shared by all processes, so that they see the same dataset version.
+    'snapshots': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'snapshots',
+    },
+    # Progress of running import jobs, shared between the worker and the
+    # web processes
+    'progress': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'progress',
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -142,5 +167,15 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS: List[str] = []
 PROXY_FRONTEND = None
 
+# Uploaded files, such as the input files of import jobs
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# The directory in which rendered vector tiles of the map are cached
+TILE_CACHE_DIRECTORY = BASE_DIR / 'cache' / 'tiles'
+
+# Log requests that take longer than this number of seconds, with their SQL
+# queries, as warnings of the data.metrics logger. None disables the log.
+SLOW_REQUEST_THRESHOLD = None
+
 # The directory to save external data, such as Pleiades data
 EXTERNAL_DATA_DIRECTORY = BASE_DIR / 'external_data'
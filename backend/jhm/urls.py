@@ -22,10 +22,11 @@ from rest_framework import routers
 
 from .index import index
 from .proxy_frontend import proxy_frontend
-from data.views import RecordViewSet
+from data.views import MetricsView, PlaceViewSet, RecordViewSet, TileView
 
 api_router = routers.DefaultRouter()  # register viewsets with this router
 api_router.register(r'records', RecordViewSet)
+api_router.register(r'places', PlaceViewSet)
 
 if settings.PROXY_FRONTEND:
     spa_url = re_path(r'^(?P<path>.*)$', proxy_frontend)
@@ -37,7 +38,9 @@ urlpatterns = [
     path('api', RedirectView.as_view(url='/api/', permanent=True)),
     path('api-auth', RedirectView.as_view(url='/api-auth/', permanent=True)),
     path('admin/', admin.site.urls),
+    path('api/tiles/<int:z>/<int:x>/<int:y>.mvt', TileView.as_view()),
     path('api/', include(api_router.urls)),
+    path('metrics', MetricsView.as_view()),
     path('api-auth/', include(
         'rest_framework.urls',
         namespace='rest_framework',